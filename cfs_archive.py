@@ -52,13 +52,81 @@ import pwd
 import grp
 import csv
 import shutil
+import stat
+import re
+import itertools
 import glob
+import io
+import threading
+import collections
+import multiprocessing
+import anydbm
+import fcntl
+import time
+import Queue
+import copy
+import json
+import resource
+import contextlib
+import struct
+import bisect
+import zlib
+import bz2
+import mmap
+import sqlite3
 import sunburnt
 import xml.etree.ElementTree as ET
 from optparse import OptionParser
 from optparse import SUPPRESS_HELP
 from functools import partial
+from multiprocessing.pool import ThreadPool
 from common_functions import *
+import cfs_catalog
+import csv_hash
+
+# os.scandir is in Python 3.5+, and the scandir package provides it for older
+# versions.  Without either, the inventory falls back to os.listdir and os.lstat.
+try:
+	from os import scandir
+except ImportError:
+	try:
+		from scandir import scandir
+	except ImportError:
+		scandir = None
+
+# Python 2 has no lzma module, but the backports.lzma package provides it for
+# the xz compression option.
+try:
+	import lzma
+except ImportError:
+	try:
+		from backports import lzma
+	except ImportError:
+		lzma = None
+
+# BLAKE2 is in the hashlib of Python 3.6+, and the pyblake2 package provides it
+# for older versions.  Without either, the blake2b and blake2s digests cannot
+# be selected.
+try:
+	from hashlib import blake2b,blake2s
+except ImportError:
+	try:
+		from pyblake2 import blake2b,blake2s
+	except ImportError:
+		blake2b,blake2s = None,None
+
+# posix_fadvise is in the os module of Python 3.3+.  On Python 2 it is called
+# from libc through ctypes, and the hints are skipped if it cannot be found.
+try:
+	from os import posix_fadvise
+except ImportError:
+	try:
+		import ctypes
+		import ctypes.util
+		posix_fadvise = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6",use_errno=True).posix_fadvise
+		posix_fadvise.argtypes = [ctypes.c_int,ctypes.c_int64,ctypes.c_int64,ctypes.c_int]
+	except (ImportError,OSError,AttributeError):
+		posix_fadvise = None
 
 
 
@@ -86,6 +154,236 @@ parser.add_option('-f', '--filename',
 	metavar='ARCHFILENAME',
 	help=('The file or directory to be archived.'))
 
+parser.add_option('-s', '--single-pass',
+	dest='single_pass_var',
+	action="store_true",
+	default=False,
+	metavar='SINGLEPASS',
+	help=('Read each file once, hashing it while it is written into the archive.'))
+
+parser.add_option('--dedup',
+	dest='dedup_var',
+	action="store_true",
+	default=False,
+	metavar='DEDUP',
+	help=('Store a reference instead of the data for files already held in an archive.'))
+
+parser.add_option('-i', '--incremental',
+	dest='incremental_var',
+	action="store_true",
+	default=False,
+	metavar='INCREMENTAL',
+	help=('Only archive files which are new or changed since they were last archived, and keep the original files.'))
+
+parser.add_option('-z', '--compress',
+	dest='compress_var',
+	type='choice',
+	choices=['gzip','bz2','xz'],
+	default=None,
+	metavar='CODEC',
+	help=('Compress the archive with gzip, bz2 or xz, in blocks compressed on all CPUs.'))
+
+parser.add_option('--compress-level',
+	dest='compress_level_var',
+	type='int',
+	default=6,
+	metavar='LEVEL',
+	help=('Compression level, 1 (fastest) to 9 (smallest).  Default is 6.'))
+
+parser.add_option('--compress-block',
+	dest='compress_block_var',
+	type='int',
+	default=4194304,
+	metavar='BYTES',
+	help=('Size of the independently compressed blocks.  Default is 4194304.'))
+
+parser.add_option('--compress-workers',
+	dest='compress_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count(),
+	metavar='WORKERS',
+	help=('Number of threads used to compress the archive.  Default is the number of CPUs.'))
+
+parser.add_option('-V', '--volume-size',
+	dest='volume_size_var',
+	type='long',
+	default=0,
+	metavar='BYTES',
+	help=('Split the archive into volumes of at most BYTES of tar each, written in parallel.'))
+
+parser.add_option('--volume-workers',
+	dest='volume_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count(),
+	metavar='WORKERS',
+	help=('Number of volumes written at the same time.  Default is the number of CPUs.'))
+
+parser.add_option('--perm-workers',
+	dest='perm_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count()*4,
+	metavar='WORKERS',
+	help=('Number of threads checking access to the files before archiving.  Default is 4 per CPU.'))
+
+parser.add_option('--rm-workers',
+	dest='rm_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count()*4,
+	metavar='WORKERS',
+	help=('Number of threads removing the original files once archived.  Default is 4 per CPU.'))
+
+parser.add_option('--hash-workers',
+	dest='hash_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count(),
+	metavar='WORKERS',
+	help=('Number of threads used to hash files.  Default is the number of CPUs.'))
+
+parser.add_option('--hash-buffer',
+	dest='hash_buffer_var',
+	type='int',
+	default=1048576,
+	metavar='BYTES',
+	help=('Size of the read buffer for each hashing thread.  Default is 1048576.'))
+
+parser.add_option('--hash-backend',
+	dest='hash_backend_var',
+	type='choice',
+	choices=['readinto','mmap'],
+	default='readinto',
+	metavar='BACKEND',
+	help=('How files are read to be hashed: readinto the reusable buffer of each thread, or mmap for files larger than the buffer.  Default is readinto.'))
+
+parser.add_option('--digests',
+	dest='digests_var',
+	default='',
+	metavar='ALGORITHMS',
+	help=('Comma separated list of extra digests computed in the same read as the id, such as sha256,blake2b.  They are added to the metadata of each file.'))
+
+parser.add_option('--id-digest',
+	dest='id_digest_var',
+	default='sha1',
+	metavar='ALGORITHM',
+	help=('Digest used as the id of each file, in the metadata, table of contents, dedup index and incremental manifest.  Default is sha1.'))
+
+parser.add_option('--tokenize',
+	dest='tokenize_var',
+	action='append',
+	default=[],
+	metavar='GLOB:COLUMNS[:SALT]',
+	help=('Tokenize the COLUMNS (comma separated, from 0) of the CSV files matching GLOB as they are archived, as csv_hash.py does.  SALT is a salt, or a file holding it on its first line.  May be repeated.'))
+
+parser.add_option('--tokenize-remove',
+	dest='tokenize_remove_var',
+	action="store_true",
+	default=False,
+	metavar='TOKENIZEREMOVE',
+	help=('Remove the original files of the tokenized files once archived.  Only their tokenized data is in the archive, so by default they are kept.'))
+
+parser.add_option('--tokenize-md5',
+	dest='tokenize_md5_var',
+	action="store_true",
+	default=False,
+	metavar='TOKENIZEMD5',
+	help=('Use MD5 against the SHA256 tokens, as the --md5 option of csv_hash.py.'))
+
+parser.add_option('--tokenize-cache',
+	dest='tokenize_cache_var',
+	type='int',
+	default=256,
+	metavar='MB',
+	help=('Memory for the cache of the tokens of each --tokenize spec.  0 disables the cache.  Default is 256.'))
+
+parser.add_option('--preload-ids',
+	dest='preload_ids_var',
+	action="store_true",
+	default=False,
+	metavar='PRELOADIDS',
+	help=('Load every user and group into the identity cache before starting.'))
+
+parser.add_option('--solr-batch',
+	dest='solr_batch_var',
+	type='int',
+	default=1000,
+	metavar='DOCS',
+	help=('Number of metadata docs sent to Solr in each request.  Default is 1000.'))
+
+parser.add_option('--solr-retries',
+	dest='solr_retries_var',
+	type='int',
+	default=5,
+	metavar='RETRIES',
+	help=('Number of times a failed Solr request is retried.  Default is 5.'))
+
+parser.add_option('--solr-standin',
+	dest='solr_standin_var',
+	action="store_true",
+	default=False,
+	metavar='SOLRSTANDIN',
+	help=SUPPRESS_HELP)
+
+parser.add_option('--publish-meta',
+	dest='publish_meta_var',
+	default='',
+	metavar='METAFILENAME',
+	help=SUPPRESS_HELP)
+
+parser.add_option('--no-catalog',
+	dest='catalog_var',
+	action="store_false",
+	default=True,
+	help=('Do not add the metadata to the catalog of the mount.'))
+
+parser.add_option('--catalog-import',
+	dest='catalog_import_var',
+	default='',
+	metavar='PATH',
+	help=('Add the metadata of an XML metadata file, or of every one below a directory, to the catalog of its mount.'))
+
+parser.add_option('--resume',
+	dest='resume_var',
+	default='',
+	metavar='JOURNALFILENAME',
+	help=('Resume an archive job that was stopped, from its journal file.'))
+
+parser.add_option('--toc-list',
+	dest='toc_list_var',
+	default='',
+	metavar='ARCHFILENAME',
+	help=('List the members of an archive from its table of contents.'))
+
+parser.add_option('--toc-stat',
+	dest='toc_stat_var',
+	default='',
+	metavar='ARCHFILENAME',
+	help=('Show the details of the --member files of an archive.'))
+
+parser.add_option('--toc-extract',
+	dest='toc_extract_var',
+	default='',
+	metavar='ARCHFILENAME',
+	help=('Unarchive only the --member files of an archive.'))
+
+parser.add_option('-m', '--member',
+	dest='member_var',
+	action='append',
+	default=[],
+	metavar='MEMBER',
+	help=('A file, directory or glob in the archive, used with the unarchive and --toc options.  May be repeated.'))
+
+parser.add_option('--member-file',
+	dest='member_file_var',
+	default='',
+	metavar='MEMBERFILENAME',
+	help=('A file listing members or globs to unarchive, one per line.'))
+
+parser.add_option('--restore-workers',
+	dest='restore_workers_var',
+	type='int',
+	default=multiprocessing.cpu_count(),
+	metavar='WORKERS',
+	help=('Number of threads used to unarchive files.  Default is the number of CPUs.'))
+
 parser.add_option('-u', '--unarch-filename',
 	dest='unarch_filename_var',
 	default='',
@@ -96,7 +394,7 @@ parser.add_option('-d','--delimiter',
 	dest='delimiter_var',
 	default=',',
 	metavar='DELIMIT',
-	help=SUPPRESS_HELP)
+	help=('The delimiter of the CSV files tokenized with --tokenize.  Default is \',\'.'))
 
 parser.add_option('-g', '--groups',
 	dest='groups_var',
@@ -141,6 +439,76 @@ archiveDir="archive"
 archiveExt=".tar"
 archiveMetaExt=".xml"
 
+# A compressed archive is written as blocks of compressBlock bytes of the tar,
+# each compressed on one of compressWorkers threads (zlib, bz2 and lzma release
+# the GIL) into a complete gzip, bzip2 or xz stream.  The blocks concatenated
+# are read by the standard tools, and the offsets of every block are written
+# to the archiveBlockExt file, so a member can be read by decompressing only
+# the blocks holding it.
+compressExts={"gzip":".gz","bz2":".bz2","xz":".xz"}
+compressCodec=opts.compress_var or ""
+compressLevel=min(9,max(1,opts.compress_level_var))
+compressBlock=max(65536,opts.compress_block_var)
+compressWorkers=max(1,opts.compress_workers_var)
+archiveBlockExt=".blocks"
+if compressCodec:
+	archiveExt=archiveExt+compressExts[compressCodec]
+
+# With --volume-size the archive is split into volumes, each holding at most
+# volumeSize bytes of tar (before any compression), with its own table of
+# contents and metadata XML.  volumeWorkers volumes are written at the same
+# time.  The archiveSetExt file lists the volumes of the set once they are all
+# complete, and is what unTarObj() restores from.
+volumeSize=max(0,opts.volume_size_var)
+volumeWorkers=max(1,opts.volume_workers_var)
+volumeTag=".vol%03d"
+archiveSetExt=".vols"
+
+# The tree being archived is walked once, into an inventory holding an invEntry
+# for every object: its resolved path, the invFields of its lstat (which hold
+# its type), and whether it is one of the top level objects given to archive.
+# Every phase of the archive works from the inventory instead of walking and
+# stating again.  Only the fields used are kept, in slots, instead of the whole
+# os.stat_result, so the memory of the inventory stays small per object.
+# The modes, owners and devices repeat across the tree, so one int object of
+# each value is shared by all of the entries, from invShared.
+invFields=("st_mode","st_uid","st_gid","st_size","st_atime","st_mtime","st_ctime",
+	"st_ino","st_dev","st_nlink","st_rdev","st_blocks")
+invSharedFields=("st_mode","st_uid","st_gid","st_dev")
+invShared={}
+
+# The metrics of an archive job are collected in jobStats, a record for each
+# phase timed by jobPhase(), and the Solr requests made by solrRetry().  They are
+# written as JSON next to the metadata XML (archiveStatsExt) once the job is done.
+archiveStatsExt=".json"
+jobStats={"phases":[],"solr_requests":0,"solr_seconds":0.0}
+
+# Every archive job keeps a journal (archiveJournalExt) in the archPath, holding
+# the job, and a line for each member once it is in the tar with its table of
+# contents entry and the offsets where it ends in the tar and the metadata XML.
+# A stopped job is resumed from the last member complete on disk.  The journal
+# is marked done once the archive is complete, and the original files are only
+# removed after that.  It is deleted once the job is finished.
+archiveJournalExt=".journal"
+
+# The archiveTocExt is the table of contents written next to each tar.  It maps
+# each member name to the offsets of its header and data, its size and SHA1,
+# so a single member can be read by seeking instead of scanning the tar.
+archiveTocExt=".idx"
+
+# The dedupIndex is a persistent index kept in the archiveDir of each client,
+# mapping the SHA1 of every file stored by the --dedup option to the archive
+# and member holding its data.  Files with a hash already in the index are
+# stored as a reference to that member instead of a second copy of the data.
+# With --id-digest the index holds that digest instead, and only matches files
+# archived with the same id digest.
+dedupIndex="dedup_index"
+
+# The incrManifest is kept next to the dedupIndex, mapping the path of every
+# file archived by the --incremental option to its inode, size, mtime, SHA1 and
+# archive.  Files with an unchanged inode, size and mtime are not hashed again.
+incrManifest="incremental_manifest"
+
 # The details for the Solr Server.  The meta data is published to the Solr
 # instance so that users can search for their archived files based on several
 # meta data parameters.
@@ -148,12 +516,122 @@ solrServer="localhost"
 solrPort="8080"
 solrInstance="live"
 
+# The metadata is also added to the catalog of the mount (cfs_catalog.py), an
+# SQLite database at the top of the mount which can be searched without Solr.
+# It is written alongside the docs published to Solr, and the XML metadata of
+# earlier archives can be imported with --catalog-import.
+
+# Metadata is published to Solr by a background thread while the files are
+# hashed and tarred.  Docs are sent solrBatch at a time, with at most
+# solrQueueDepth docs waiting.  A failed request is retried solrRetries times,
+# waiting solrBackoff seconds and doubling the wait after each attempt.
+solrBatch=max(1,opts.solr_batch_var)
+solrQueueDepth=solrBatch*4
+solrRetries=max(0,opts.solr_retries_var)
+solrBackoff=1
+
+# The hashing engine used by perfMeta().  Each of the hashWorkers threads reads
+# files into its own reusable buffer of hashBuffer bytes, so the memory used by
+# hashing is hashWorkers * hashBuffer no matter how large the files are.
+hashWorkers=max(1,opts.hash_workers_var)
+hashBuffer=max(4096,opts.hash_buffer_var)
+hashLocal=threading.local()
+
+# Every file is hashed with each of hashDigests, from the same buffers, so the
+# extra digests cost CPU but no extra read of the data.  The idDigest comes
+# first and is the id of the file.  The others are added to its metadata as
+# fields named after them, and idDigest as the id_digest field unless it is
+# sha1.  The blake2 digests are not in hashlib.new() on Python 2.
+idDigest=opts.id_digest_var.strip().lower()
+hashDigests=[idDigest]
+for digestName in opts.digests_var.lower().split(","):
+	if digestName.strip() and digestName.strip() not in hashDigests:
+		hashDigests.append(digestName.strip())
+blake2Digests={"blake2b":blake2b,"blake2s":blake2s}
+
+# With --tokenize, the CSV files matching a glob are archived with some of their
+# columns tokenized by csv_hash.py as they are streamed into the tar, and no
+# tokenized copy is written.  Each of tokenSpecs holds the glob, columns and
+# salt of a --tokenize option, and a token cache of tokenCache MB.  The header
+# of a member needs the size of its data, so the matching files are tokenized
+# once before the tar, into tokenized{}: the size and digests of the tokenized
+# data, and the digests of the original, by path.  The id of a tokenized file is
+# the id of its tokenized data, as it is in the archive, and the id of the
+# original is added to its metadata as original_id.  The original data is not
+# in the archive, so the original files are only removed with tokenizeRemove.
+tokenSpecs=[]
+tokenized={}
+tokenDelimiter=opts.delimiter_var
+tokenMd5=opts.tokenize_md5_var
+tokenizeRemove=opts.tokenize_remove_var
+tokenCache=max(0,opts.tokenize_cache_var)
+
+# With the mmap backend, files larger than hashBuffer are hashed a window of
+# hashMmapWindow bytes at a time, so the memory mapped stays the same for any
+# size of file.  A file truncated while it is mapped raises SIGBUS, which is
+# why readinto is the default.
+hashBackend=opts.hash_backend_var
+hashMmapWindow=67108864
+
+# The files are read with the sequential read-ahead hint.  Once hashed, the
+# pages of files of hashDropMin bytes or more are dropped from the page cache:
+# they would push out the rest of the cache, and are not likely to still be
+# cached when the tar reads them.  The files are dropped once tarred, since
+# they are about to be removed.
+fadvSequential=getattr(os,"POSIX_FADV_SEQUENTIAL",2)
+fadvDontNeed=getattr(os,"POSIX_FADV_DONTNEED",4)
+hashDropMin=67108864
+
+# A file with fewer blocks allocated than its size has holes.  Its data extents
+# are found with lseek(SEEK_DATA/SEEK_HOLE), which Python 2 has no constants
+# for, and only the extents are read.  They are stored as GNU sparse members
+# (which tarfile restores), and the holes are hashed from zeroBlock in memory.
+seekData=getattr(os,"SEEK_DATA",3)
+seekHole=getattr(os,"SEEK_HOLE",4)
+zeroBlock="\0"*1048576
+
+# Before archiving, access to every object beneath the targets is checked as
+# the sudo user on permWorkers threads, permBatch objects at a time.  The checks
+# wait on the storage more than the CPU, so there are several threads per CPU.
+# The report lists the first permReportMax objects denied.
+permWorkers=max(1,opts.perm_workers_var)
+permBatch=256
+permReportMax=50
+
+# Once archived, the original files are removed on rmWorkers threads, each
+# unlinking rmBatch files from one directory at a time.  The progress is
+# printed to archive.out every rmReport seconds.
+rmWorkers=max(1,opts.rm_workers_var)
+rmBatch=1024
+rmReport=10
+
+# Unarchiving writes the files on restoreWorkers threads, each reading its own
+# handle on the tar, restoreBatch members at a time.
+restoreWorkers=max(1,opts.restore_workers_var)
+restoreBatch=64
+
 
 ################################################################################
 # Functions
 ################################################################################
 
 ##### Included from common_functions:
+##### Identity Cache
+## cached_pwuid(user):
+## cached_pwnam(user):
+## cached_grgid(group):
+## cached_grnam(group):
+## group_members(group):
+## preload_ids():
+## clear_ids():
+
+##### Mount Cache
+## cached_ismount(path):
+## clear_mounts():
+
+##### Solr Schema Cache
+## cache_solr_schema(url):
+
 ##### Validations
 ## user_exists(user):
 ## uid_exists(user):
@@ -174,142 +652,510 @@ solrInstance="live"
 
 
 # PUBLISH META DATA TO SOLR
-def publishMeta(mdList):
-	""" Establish the Solr Instance, add the metadata, and commit it"""
+def publishMeta(metaFile):
+	""" Publish the metadata of an existing XML metadata file to Solr"""
+	publisher = publishStart()
+	for fileDict in readMeta(metaFile):
+		publishDoc(publisher,fileDict)
+	publishEnd(publisher)
+
+
+
+def publishStart(catalogFile=None):
+	""" Start the background thread which publishes metadata docs to Solr, and open the catalog if given"""
+	# The publisher is a plain dict shared with the thread: the bounded queue
+	# of docs, and the exception that stopped the thread, if any.  The docs
+	# are added to the catalog as they are queued.
+	publisher = {"queue":Queue.Queue(solrQueueDepth),"error":None,"docs":0,"catalog":None}
+	if catalogFile is not None:
+		publisher["catalog"] = cfs_catalog.catalogStart(catalogFile)
+	publisher["thread"] = threading.Thread(target=publishWorker,args=(publisher,))
+	publisher["thread"].daemon = True
+	publisher["thread"].start()
+	return(publisher)
+
+
+
+def publishDoc(publisher,fileDict):
+	""" Queue a metadata doc for Solr, waiting while the queue is full"""
+	if publisher["error"] is not None:
+		publishEnd(publisher)
+	if publisher["catalog"] is not None:
+		cfs_catalog.catalogDoc(publisher["catalog"],fileDict)
+	publisher["queue"].put(fileDict)
+
+
+
+def publishEnd(publisher):
+	""" Wait for the queued docs to be added and committed to Solr, and the catalog to be written"""
+	publisher["queue"].put(None)
+	publisher["thread"].join()
+	# The catalog is only a local index of the metadata, so the job carries
+	# on without it, as with --no-catalog
+	if publisher["catalog"] is not None and not catalogEnd(publisher["catalog"]):
+		print("Continuing without the catalog, --catalog-import adds this job later")
+	if publisher["error"] is not None:
+		print("Error publishing the metadata to Solr: "+str(publisher["error"]))
+		sys.exit(3000)
+	print("Metadata published: "+str(publisher["docs"]))
+
+
+
+def catalogEnd(catalog):
+	""" Write the rest of the docs to the catalog and close it, False if it could not be written"""
+	try:
+		docs = cfs_catalog.catalogEnd(catalog)
+	except (sqlite3.Error,ValueError) as e:
+		print("Error writing the catalog "+catalog["file"]+": "+str(e))
+		return(False)
+	print("Catalog updated: "+str(docs))
+	return(True)
+
+
+
+def catalogImport(importPath):
+	""" Add the metadata of an XML metadata file, or of every one below a directory, to the catalog of its mount"""
+	# Only the metadata written by cfs_archive.py is imported, which is in
+	# the archive dirs that only root can write to
+	importPath = os.path.realpath(importPath)
+	found = None
+	try:
+		found = findMount(importPath)
+	except IndexError:
+		pass
+	if not os.path.exists(importPath) or found is None:
+		print("No metadata to import: "+importPath)
+		sys.exit(3020)
+	archiveTop = os.path.join(found[0],found[2],archiveDir)
+	if importPath != archiveTop and not importPath.startswith(archiveTop+"/"):
+		print("Not in an archive directory: "+importPath)
+		sys.exit(3020)
+	metaFiles = [importPath]
+	if os.path.isdir(importPath):
+		metaFiles = []
+		for dirPath,dirNames,fileNames in os.walk(importPath):
+			dirNames.sort()
+			metaFiles.extend([os.path.join(dirPath,fileName) for fileName in sorted(fileNames) if fileName.endswith(archiveMetaExt)])
+
+	catalog = cfs_catalog.catalogStart(cfs_catalog.catalogPath(found[0]))
+	for metaFile in metaFiles:
+		# The metadata of a job still in its journal is not complete yet,
+		# it is added to the catalog when the job finishes.
+		stem = re.sub(r"\.vol[0-9]+$","",os.path.splitext(metaFile)[0])
+		if os.path.exists(stem+archiveJournalExt):
+			print("Skipping the unfinished job: "+metaFile)
+			continue
+		for fileDict in readMeta(metaFile):
+			cfs_catalog.catalogDoc(catalog,fileDict)
+	if not catalogEnd(catalog):
+		sys.exit(3010)
+
+
+
+def publishWorker(publisher):
+	""" Establish the Solr Instance, add the queued metadata in batches, and commit it"""
+	queue = publisher["queue"]
+	fileDict = {}
 	try:
 		# Instantiate the interface to the Solr instance
-		si = sunburnt.SolrInterface("http://%s:%s/solr/%s/" % (solrServer,solrPort,solrInstance))
-		# Add the XML metadata to the instance
-		si.add(mdList)
-	except:
-		raise
-	finally:
-		# Commit/Save the metadata
-		si.commit()
+		si = solrRetry(solrInterface,solrUrl())
+
+		# Add the XML metadata to the instance, solrBatch docs per request
+		batch = []
+		fileDict = queue.get()
+		while fileDict is not None:
+			batch.append(fileDict)
+			if len(batch) >= solrBatch:
+				solrRetry(si.add,batch,len(batch))
+				publisher["docs"] += len(batch)
+				batch = []
+			fileDict = queue.get()
+		if batch:
+			solrRetry(si.add,batch,len(batch))
+			publisher["docs"] += len(batch)
+
+		# Commit/Save the metadata once everything has been added
+		solrRetry(si.commit)
+
+	except Exception as e:
+		publisher["error"] = e
+		# Keep taking docs until the end of the queue, so nothing waiting
+		# to queue a doc is left blocked.
+		while fileDict is not None:
+			fileDict = queue.get()
+
+
+
+def solrUrl():
+	""" Return the URL of the Solr instance the metadata is published to"""
+	return("http://%s:%s/solr/%s/" % (solrServer,solrPort,solrInstance))
+
+
+
+def solrInterface(url):
+	""" Connect to a Solr instance, with the cached copy of its schema if cfs_archived.py fetched one"""
+	schemaDoc = solrSchemas.get(url)
+	if schemaDoc is None:
+		return(sunburnt.SolrInterface(url))
+	return(sunburnt.SolrInterface(url,schemadoc=io.BytesIO(schemaDoc)))
+
+
+
+def solrRetry(func,*args):
+	""" Call a Solr function, retrying with an exponential backoff if it fails"""
+	attempt = 0
+	while True:
+		start = time.time()
+		try:
+			return(func(*args))
+		except Exception:
+			if attempt >= solrRetries:
+				raise
+			time.sleep(solrBackoff*(2**attempt))
+			attempt += 1
+		finally:
+			jobStats["solr_requests"] += 1
+			jobStats["solr_seconds"] += time.time()-start
+
+
+
+def readMeta(metaFile):
+	""" Yield the metadata dict of each 'doc' in an XML metadata file"""
+	# iterparse() keeps every element it has seen attached to the 'add'
+	# element, so clear it after each doc to keep the memory flat.
+	xmlTop = None
+	for event,elem in ET.iterparse(metaFile,events=("start","end")):
+		if event == "start":
+			if xmlTop is None:
+				xmlTop = elem
+		elif elem.tag == "doc":
+			yield(dict((field.get("name"),field.text) for field in elem))
+			xmlTop.clear()
 
 
 
 # META DATA CREATION
-def perfMeta(fileNameList,archPath,mnt,client):
+def perfMeta(inventory,archPath,mnt,client,manifest=None,changed=None,hashes=None,publisher=None):
 	""" Create the metadata for the file for search engine """
 
 	# Declare the archFile and metaFile locations
 	archFile = os.path.join(archPath,fileStamp+archiveExt)
 	metaFile = os.path.join(archPath,fileStamp+archiveMetaExt)
 
-	# Create an empty list for the file/dir metadata
-	mdList = []
+	# Open the metaFile and write the XML element "add".  This element is
+	# required for Solr to add it to the instance.  All of the file metadata
+	# xml 'doc' entries are written under this element as each file is hashed.
+	metaFh = metaOpen(metaFile)
 
-	# Create the XML element "add".  This element is required
-	# for Solr to add it to the instance.  All of the file
-	# metadata xml 'doc' entries will go under this element.
-	xmlTop = ET.Element("add")
+	# For an incremental archive, files unchanged since the manifest was
+	# written are dropped before they are hashed.
+	entries = metaFiles(inventory)
+	if manifest is not None:
+		entries = changedEntries(entries,manifest,changed)
 
+	# Hash the files on the thread pool.  The results come back in the order
+	# the files were found, so the metadata is created in the same order.
+	for entry,fileDigests in hashFiles(entries):
+		fileName = entry.path
+		fileHash = fileDigests[idDigest]
 
-	# For each file name in the list passed to the function
-	for fileName in fileNameList:
-		# Check if the file is an actual file
-		if os.path.isfile(fileName):
+		if changed is not None:
+			changed[fileName] += "\t"+fileHash+"\t"+archFile
 
-			# Create an empty dict for the file
-			fileDict={}
+		# tarObj() needs the hashes for a dedup or incremental archive
+		if hashes is not None:
+			hashes[fileName] = fileHash
 
-			fileDict = fileInfo(fileName)
-			fileDict["id"] = perfHash(fileName)
-			fileDict["market"] = client
-			fileDict["mount"] = mnt
-			fileDict["archive_name"] = archFile
-			fileDict["archive_time"] = tdyISO
-			fileDict["archive_owner"] = sudoUser
+		# Collect the metadata for the file, write it to the XML, and queue
+		# it to be published to Solr
+		fileDict = fileMeta(fileName,fileDigests,archFile,mnt,client,entry.stat)
+		metaWrite(metaFh,fileDict)
+		if publisher is not None:
+			publishDoc(publisher,fileDict)
 
-			# Create a 'doc' element under 'add' for the file data
-			xmlRecord = ET.SubElement(xmlTop,"doc")
+	# Close the "add" element of the metaFile
+	metaClose(metaFh)
 
-			# For each metadata key in the file dict, create a field
-			# in the XML and add the value.
-			for key in fileDict:
-				field = ET.SubElement(xmlRecord,"field",name=key)
-				field.text = str(fileDict[key])
 
-			# For each file, add the meta data to the mdList[]
-			mdList.append(fileDict)
 
+def metaFiles(inventory):
+	""" Yield the inventory entry of every regular file, including the files in directories"""
+	for entry in inventory:
+		if stat.S_ISREG(entry.stat.st_mode):
+			yield entry
 
 
-		# The file wasn't a file, so check if it's a directory
-		elif os.path.isdir(fileName):
-			# It is a directory, so attempt to traverse it for file names.
-			try:
-				# os.walk() produces 3 pieces of information, only two of which
-				# we're going to use:  root and files.
-				for root,dirs,files in os.walk(fileName):
-					# For each file that was discovered in the os.walk()
-					for names in files:
-						# Create a quick variable and set it to the path and name
-						# of the file in question.
-						fn=os.path.join(root,names)
-
-						# Create an empty dict for the file
-						fileDict={}
-
-						fileDict = fileInfo(fn)
-						fileDict["id"] = perfHash(fn)
-						fileDict["market"] = client
-						fileDict["mount"] = mnt
-						fileDict["archive_name"] = archFile
-						fileDict["archive_time"] = tdyISO
-						fileDict["archive_owner"] = sudoUser
-
-						# Create a 'doc' element under the 'add' for the file data
-						xmlRecord = ET.SubElement(xmlTop,"doc")
-
-						# For each metadata key in the file dict, create a field
-						# in the XML and add the value.
-						for key in fileDict:
-							field = ET.SubElement(xmlRecord,"field",name=key)
-							field.text = str(fileDict[key])
-
-						# For each file, add the meta data to the mdList[]
-						mdList.append(fileDict)
-
-
-			# Couldn't os.walk() the directory.  Probably a permissions problem.
-			except:
-				raise
 
-		# Not a file, or a directory, so don't hash it.
-		else:
-			pass
+def fileChanged(fileName,manifest,changed,fileData=None):
+	""" Compare a file against the incremental manifest, recording its stat if it changed"""
+	if fileData is None:
+		fileData = os.stat(fileName)
+	statKey = "%d\t%d\t%r" % (fileData.st_ino,fileData.st_size,fileData.st_mtime)
+	if manifest.has_key(fileName) and manifest[fileName].startswith(statKey+"\t"):
+		return(False)
+	changed[fileName] = statKey
+	return(True)
 
-	# Write out the metaFile with the full XML data of all the files
-	ET.ElementTree(xmlTop).write(metaFile)
 
-	# Publish the metadata to Solr
-	publishMeta(mdList)
 
+def changedEntries(entries,manifest,changed):
+	""" Yield the inventory entries which are not files, or are new or changed since the manifest was written"""
+	for entry in entries:
+		if not stat.S_ISREG(entry.stat.st_mode) or fileChanged(entry.path,manifest,changed,entry.stat):
+			yield entry
 
 
-def perfHash(fileName):
-	""" Perform a SHA1 hash against a file.  Constructed using partial buffers to avoid memory problems"""
+
+def hashFiles(entries):
+	""" Hash the files of inventory entries on a pool of hashWorkers threads, yielding (entry,digests) in order"""
+	# hashlib releases the GIL while hashing, so threads are enough to use
+	# all of the cores.  Only a few files per thread are queued at a time, so
+	# the number of pending results stays bounded for any number of files.
+	pool = ThreadPool(hashWorkers)
+	pending = collections.deque()
+	# A file with several hardlinks is hashed once, for its first link
+	inodes = {}
 	try:
-		# Open the file so we can read chunks at a time to prevent a memory
-		# over run when dealing with very large files
-		with open(fileName, mode='rb') as f:
-		# Set d to the appropriate hash library, sha1 in this case
-			d = hashlib.sha1()
-			# For each 1024M block of partial data
-			for buf in iter(partial(f.read, 1073741824), b''):
-				# Update the hash object with the 1024M block
-				d.update(buf)
-		return(d.hexdigest())
+		for entry in entries:
+			inode = None
+			if entry.stat.st_nlink > 1:
+				inode = (entry.stat.st_dev,entry.stat.st_ino)
+			result = inodes.get(inode)
+			if result is None:
+				result = pool.apply_async(perfHash,(entry.path,entry.stat))
+				if inode is not None:
+					inodes[inode] = result
+			pending.append((entry,result))
+			if len(pending) >= hashWorkers*4:
+				entry,result = pending.popleft()
+				yield(entry,result.get())
+
+		while pending:
+			entry,result = pending.popleft()
+			yield(entry,result.get())
+	finally:
+		pool.terminate()
+		pool.join()
+
+
+
+def fileMeta(fileName,fileDigests,archFile,mnt,client,fileData=None):
+	""" Create the full metadata dictionary for a file that has been hashed"""
+	fileDict = fileInfo(fileName,fileData)
+	fileDict["id"] = fileDigests[idDigest]
+	for digestName in fileDigests:
+		if digestName != idDigest:
+			fileDict[digestName] = fileDigests[digestName]
+	if idDigest != "sha1":
+		fileDict["id_digest"] = idDigest
+	# The size is that of the data in the archive, like the id
+	token = tokenized.get(fileName)
+	if token is not None:
+		fileDict["original_size"] = fileDict["size"]
+		fileDict["size"] = token["size"]
+		fileDict["original_id"] = token["original"][idDigest]
+		fileDict["tokenized_columns"] = ",".join([str(field) for field in token["spec"]["fields"]])
+	fileDict["market"] = client
+	fileDict["mount"] = mnt
+	fileDict["archive_name"] = archFile
+	fileDict["archive_time"] = tdyISO
+	fileDict["archive_owner"] = sudoUser
+	return(fileDict)
+
+
+
+def xmlDoc(fileDict):
+	""" Create a 'doc' element for the file metadata, to go under the 'add' element"""
+	xmlRecord = ET.Element("doc")
+
+	# For each metadata key in the file dict, create a field
+	# in the XML and add the value.
+	for key in fileDict:
+		field = ET.SubElement(xmlRecord,"field",name=key)
+		field.text = str(fileDict[key])
+	return(xmlRecord)
+
+
+
+def metaOpen(metaFile,offset=None):
+	""" Open an XML metadata file for writing, and start the 'add' element, or carry on from offset"""
+	if offset is not None:
+		metaFh = open(metaFile,"r+b",1048576)
+		metaFh.seek(offset)
+		metaFh.truncate()
+		return(metaFh)
+	metaFh = open(metaFile,"wb",1048576)
+	metaFh.write("<add>")
+	return(metaFh)
+
+
+
+def metaWrite(metaFh,fileDict):
+	""" Write the 'doc' element for a file to an XML metadata file"""
+	metaFh.write(ET.tostring(xmlDoc(fileDict)))
+
+
+
+def metaClose(metaFh):
+	""" End the 'add' element and close an XML metadata file"""
+	metaFh.write("</add>")
+	metaFh.close()
+
+
+
+def perfHash(fileName,fileData=None):
+	""" Hash a file with each of hashDigests, returning a dict of the hex digests.  Constructed using a small reusable buffer per thread to avoid memory problems"""
+	# Each hashing thread keeps its own buffer, so the file data is read into
+	# the same memory for every file instead of allocating a new string per read
+	buf = getattr(hashLocal,"buf",None)
+	if buf is None:
+		buf = hashLocal.buf = bytearray(hashBuffer)
+	view = memoryview(buf)
+	# A tokenized file is archived as its tokenized data, which was hashed
+	# when it was tokenized
+	token = tokenized.get(fileName)
+	if token is not None:
+		return(dict(token["digests"]))
+	try:
+		# Open the file unbuffered, since the data is read straight into buf
+		with io.open(fileName, mode='rb', buffering=0) as f:
+		# Set d to the hash objects of every digest, all fed in the same read
+			d = FileDigest()
+			fd = f.fileno()
+			fileAdvise(fd,fadvSequential)
+			fileSize = os.fstat(fd).st_size
+			# Only the data extents of a sparse file are read
+			extents = None
+			if fileData is not None and sparseFile(fileData):
+				extents = fileExtents(fd,fileData.st_size)
+			if extents is not None:
+				hashExtents(d,f,extents,view)
+			elif hashBackend == "mmap" and fileSize > hashBuffer:
+				hashMapped(d,fd,fileSize)
+			else:
+				# For each block of data read into the buffer
+				for size in iter(partial(f.readinto, buf), 0):
+					# Update the hash object with the filled part of the buffer
+					d.update(view[:size])
+			if fileSize >= hashDropMin:
+				fileAdvise(fd,fadvDontNeed)
+		return(d.hexdigests())
 	except:
 		raise
 
 
 
-def fileInfo(fileName):
+def digestNew(digestName):
+	""" Return a new hash object for a digest algorithm, by its hashlib name"""
+	if digestName in blake2Digests:
+		if blake2Digests[digestName] is None:
+			raise ValueError("unsupported hash type "+digestName)
+		return(blake2Digests[digestName]())
+	return(hashlib.new(digestName))
+
+
+
+class FileDigest(object):
+	"""Feed the same data to the hash objects of several digest algorithms"""
+	def __init__(self,digestNames=None):
+		self.digestNames=digestNames or hashDigests
+		self.digests=[digestNew(digestName) for digestName in self.digestNames]
+
+	def update(self,data):
+		for digest in self.digests:
+			digest.update(data)
+
+	def hexdigests(self):
+		return(dict(zip(self.digestNames,[digest.hexdigest() for digest in self.digests])))
+
+
+
+def hashMapped(digest,fd,size):
+	""" Hash the first size bytes of a file through mmap, one window of hashMmapWindow bytes at a time"""
+	for offset in xrange(0,size,hashMmapWindow):
+		window = mmap.mmap(fd,min(hashMmapWindow,size-offset),access=mmap.ACCESS_READ,offset=offset)
+		try:
+			digest.update(window)
+		finally:
+			window.close()
+
+
+
+def fileAdvise(fd,advice):
+	""" Give the kernel a hint on how the whole of a file will be read, if posix_fadvise is available"""
+	if posix_fadvise is not None:
+		posix_fadvise(fd,0,0,advice)
+
+
+
+def hashExtents(digest,f,extents,view):
+	""" Hash the data extents of a sparse file read into view, and the holes between them as zeros"""
+	position = 0
+	for offset,length in extents:
+		hashZeros(digest,offset-position)
+		f.seek(offset)
+		while length > 0:
+			size = f.readinto(view[:min(length,len(view))])
+			if not size:
+				raise IOError("Unexpected end of data in "+f.name)
+			digest.update(view[:size])
+			length -= size
+		position = f.tell()
+	return(position)
+
+
+
+def hashZeros(digest,length):
+	""" Hash length zero bytes, the contents of a hole"""
+	while length > 0:
+		if length >= len(zeroBlock):
+			digest.update(zeroBlock)
+		else:
+			digest.update(zeroBlock[:length])
+		length -= len(zeroBlock)
+
+
+
+def sparseFile(fileData):
+	""" Return True if a regular file has fewer blocks allocated than its size, so it may have holes"""
+	return(stat.S_ISREG(fileData.st_mode) and fileData.st_blocks*512 < fileData.st_size)
+
+
+
+def fileExtents(fd,size):
+	""" Return the (offset,length) data extents in the first size bytes of a file, None if it has no holes"""
+	# A file ending in a hole gets a last extent of (size,0), as GNU tar
+	# writes it.  A filesystem without SEEK_DATA support reports the whole
+	# file as data, which is read as usual.
+	extents = []
+	offset = 0
+	try:
+		while offset < size:
+			start = os.lseek(fd,offset,seekData)
+			if start >= size:
+				break
+			end = min(os.lseek(fd,start,seekHole),size)
+			extents.append((start,end-start))
+			offset = end
+	except OSError as e:
+		# ENXIO: no more data after offset
+		if e.errno != errno.ENXIO:
+			return(None)
+	finally:
+		os.lseek(fd,0,os.SEEK_SET)
+	if extents == [(0,size)]:
+		return(None)
+	if not extents or sum(extents[-1]) < size:
+		extents.append((size,0))
+	return(extents)
+
+
+
+def fileInfo(fileName,fileData=None):
 	""" Create a basic dictionary containing file information and return it"""
-	fileData=os.stat(fileName)
+	# The stat is taken from the inventory, when there is one
+	if fileData is None:
+		fileData=os.stat(fileName)
 	fileDict={}
 	fileDict["atime"]=time8601(fileData.st_atime)
 	fileDict["mtime"]=time8601(fileData.st_mtime)
@@ -362,7 +1208,7 @@ def findMount(obj,i=0):
 
 		# Root (/) is a mounted filesystem, but not the one we're looking for, so
 		# ignore the first loop round, and test if the obj_mount is a filesystem
-		if os.path.ismount(obj_mount) and i > 0:
+		if cached_ismount(obj_mount) and i > 0:
 
 			# If we've found the mount path, then join up the remainder of the path
 			# into a single variable to be returned.
@@ -385,7 +1231,75 @@ def tarExclude(fileName):
 
 
 
-def tarObj(fileNameList,archPath):
+def dedupMember(tarinfo,hashes,index,stored,tarFile):
+	"""Replace the data of a file already held in an archive with a reference"""
+	fileHash = hashes.get(os.path.join("/",tarinfo.name))
+	if not tarinfo.isreg() or fileHash is None:
+		return(tarinfo)
+
+	# Files stored earlier in this archive are not in the index until the
+	# archive is complete, so check those first.
+	if stored.has_key(fileHash):
+		ref = stored[fileHash]
+	elif index.has_key(fileHash):
+		ref = index[fileHash]
+	else:
+		stored[fileHash] = tarFile+"\t"+tarinfo.name
+		return(tarinfo)
+
+	# The reference is kept in the pax headers of an empty member, which
+	# unTarObj() resolves back to the data on restore.
+	tarinfo.pax_headers = {u"CFS.sha1":fileHash.decode("utf-8"),u"CFS.ref":ref.decode("utf-8")}
+	# CFS.sha1 holds the id, and CFS.digest its algorithm when not sha1
+	if idDigest != "sha1":
+		tarinfo.pax_headers[u"CFS.digest"] = idDigest.decode("utf-8")
+	tarinfo.size = 0
+	return(tarinfo)
+
+
+
+def dedupVerify(tarinfo,hashes,stored,tarFile,fileHash):
+	"""Keep a file out of the dedup index when its data changed after it was hashed"""
+	# stored is keyed on the hash from perfMeta(), so a file which changed
+	# before it was tarred would point that hash at different data
+	oldHash = hashes.get(os.path.join("/",tarinfo.name))
+	if oldHash != fileHash and stored.get(oldHash) == tarFile+"\t"+tarinfo.name:
+		del stored[oldHash]
+		print("File changed after it was hashed, not used for dedup: "+tarinfo.name)
+
+
+
+def openIndex(indexFile):
+	"""Open a persistent hash index for reading, an empty dict if none exists yet"""
+	try:
+		return(anydbm.open(indexFile,"r"))
+	except anydbm.error:
+		return({})
+
+
+
+def closeIndex(index):
+	"""Close a hash index from openIndex()"""
+	# The empty dict given when there is no index yet has nothing to close
+	if hasattr(index,"close"):
+		index.close()
+
+
+
+def updateIndex(indexFile,entries):
+	"""Add entries to a persistent hash index, locked against other archive jobs"""
+	with open(indexFile+".lock","a") as lock:
+		fcntl.flock(lock,fcntl.LOCK_EX)
+		index = anydbm.open(indexFile,"c")
+		try:
+			for key in entries:
+				index[key] = entries[key]
+		finally:
+			index.close()
+
+
+
+def tarObj(inventory,archPath,dedupFile=None,hashes=None,incremental=False,journal=None):
 	"""Tar a file or directory"""
 	# The checkPerm function downgraded the privs of the process to the
 	# original sudo user.  Now re-escalate the privledges to root so we 
@@ -397,17 +1311,58 @@ def tarObj(fileNameList,archPath):
 
 		tarFile=os.path.join(archPath,fileStamp+archiveExt)
 
+		# With dedup, the hashes from perfMeta() are checked against the
+		# index as each file is added.  References need pax headers.  An
+		# incremental archive only takes the files perfMeta() hashed.
+		tarFormat=tarfile.DEFAULT_FORMAT
+		if dedupFile:
+			tarFormat=tarfile.PAX_FORMAT
+			index=openIndex(dedupFile)
+			stored={}
+
+		# The table of contents is written as each member is added
+		toc=tocOpen(tarFile,journal)
+
 		# Attempt to open the file with the datetime prefix.  File is opened
-		# as a gzipped compressed tar file. This action is performed as root.
-		with tarfile.open(tarFile,mode="w",bufsize=102400) as tarobj:
-			for i in fileNameList:
-				# Add the target object to the gzipped tar archive
-				tarobj.add(i,exclude=tarExclude)
-				print("Completed: "+i)
+		# as a tar file, compressed if requested. This action is performed as root.
+		# A resumed job carries on after the members already in its journal.
+		archFh=archiveOpen(tarFile,journal)
+		with tarfile.open(tarFile,mode="w",fileobj=archFh,format=tarFormat) as tarobj:
+			# An incremental archive only takes the files perfMeta() hashed.
+			# They are left out before the TarInfos are created, so a hardlink
+			# is only made to a file which is in the tar.
+			entries=journalEntries(inventory,journal)
+			if incremental:
+				entries=(entry for entry in entries if not stat.S_ISREG(entry.stat.st_mode) or hashes.has_key(entry.path))
+			for entry,tarinfo in tarMembers(tarobj,entries):
+				fileName = entry.path
+				if dedupFile:
+					tarinfo=dedupMember(tarinfo,hashes,index,stored,tarFile)
+
+				# Add the target object to the tar archive.  The data is
+				# hashed again as it is written, with only the id digest
+				# for the table of contents.
+				if tarinfo.isreg() and "CFS.ref" not in tarinfo.pax_headers:
+					offsets,fileDigests = addFile(tarobj,tarinfo,fileName,entry.stat,[idDigest])
+					fileHash = fileDigests[idDigest]
+					if dedupFile:
+						dedupVerify(tarinfo,hashes,stored,tarFile,fileHash)
+				else:
+					offsets = addMember(tarobj,tarinfo)
+					fileHash = str(tarinfo.pax_headers.get("CFS.sha1",""))
+				tocWrite(toc,tarinfo,offsets,fileHash)
+				journalMember(journal,tarobj,tarinfo,offsets,fileHash)
 				# Writing completed, now close the archive
 			tarobj.close()
+			archFh.close()
+			toc.close()
 			print("Archive file: "+tarFile)
-			return(True)
+
+		# Only files in a complete archive can be referenced by later archives
+		if dedupFile:
+			closeIndex(index)
+			updateIndex(dedupFile,stored)
+		return(True)
 
 	# Check for any errors     
 	except:
@@ -417,30 +1372,1131 @@ def tarObj(fileNameList,archPath):
 
 
 
-def unTarObj(fileName):
-	"""unTar a file or directory"""
+def archiveStem(archFile):
+	"""Strip the .tar and any compression extension from an archive name"""
+	stem,ext = os.path.splitext(archFile)
+	if ext in compressExts.values():
+		stem,ext = os.path.splitext(stem)
+	return(stem)
+
+
+
+def archiveCreate(archFile):
+	"""Open the file the tar is written to, compressed in blocks if --compress is set"""
+	if compressCodec:
+		return(BlockWriter(archFile,compressCodec))
+	return(open(archFile,"wb",1048576))
+
+
+
+def archiveOpen(archFile,journal=None):
+	"""Open the file the tar is written to, at the end of the journal of a resumed job"""
+	if journal is None or journal["offset"] is None:
+		return(archiveCreate(archFile))
+	archFh = open(archFile,"r+b",1048576)
+	archFh.seek(journal["offset"])
+	archFh.truncate()
+	return(archFh)
+
+
+
+def tocOpen(archFile,journal=None):
+	"""Create the table of contents of an archive, holding the members in the journal of a resumed job"""
+	# The table of contents is not synced as it is written, so it is
+	# rebuilt from the journal rather than trusted after a stop
+	toc = tocCreate(archFile)
+	if journal is not None and journal["offset"] is not None:
+		for member in journal["members"]:
+			toc[member[6]] = "\t".join(member[:4])
+	return(toc)
+
+
+
+def openArchive(archFile):
+	"""Open an archive for reading, through its block index if it was compressed in blocks"""
+	blockFile = archiveStem(archFile)+archiveBlockExt
+	if os.path.exists(blockFile):
+		return(tarfile.open(archFile,mode="r:",fileobj=BlockReader(archFile,blockFile)))
+	return(tarfile.open(archFile,"r"))
+
+
+
+def blockCompress(codec,data):
+	"""Compress a block of the tar into a complete gzip, bzip2 or xz stream"""
+	if codec == "gzip":
+		# A raw deflate stream with a gzip header and trailer, so each block
+		# is a gzip member of its own
+		c = zlib.compressobj(compressLevel,zlib.DEFLATED,-zlib.MAX_WBITS)
+		body = c.compress(data)+c.flush()
+		trailer = struct.pack("<LL",zlib.crc32(data) & 0xffffffff,len(data) & 0xffffffff)
+		return("\x1f\x8b\x08\x00\x00\x00\x00\x00\x00\xff"+body+trailer)
+	elif codec == "bz2":
+		return(bz2.compress(data,compressLevel))
+	elif codec == "xz":
+		return(lzma.compress(data,preset=compressLevel))
+
+
+
+def blockDecompress(codec,block):
+	"""Decompress a block written by blockCompress"""
+	if codec == "gzip":
+		return(zlib.decompress(block,16+zlib.MAX_WBITS))
+	elif codec == "bz2":
+		return(bz2.decompress(block))
+	elif codec == "xz":
+		return(lzma.decompress(block))
+
+
+
+class BlockWriter(object):
+	"""File object for tarfile which compresses the tar in blocks on a thread pool"""
+	def __init__(self,archFile,codec):
+		self.fileObj=open(archFile,"wb")
+		self.blockFile=archiveStem(archFile)+archiveBlockExt
+		self.codec=codec
+		self.buf=[]
+		self.bufSize=0
+		# Offsets in the tar, and in the compressed file
+		self.offset=0
+		self.compOffset=0
+		self.blocks=[]
+		self.pool=ThreadPool(compressWorkers)
+		self.pending=collections.deque()
+
+	def write(self,data):
+		self.buf.append(data)
+		self.bufSize+=len(data)
+		self.offset+=len(data)
+		if self.bufSize >= compressBlock:
+			self.compressBuf()
+
+	def tell(self):
+		return(self.offset)
+
+	def compressBuf(self):
+		# Queue the buffered data to be compressed, and write out the oldest
+		# blocks once enough are waiting to keep every thread busy
+		data="".join(self.buf)
+		result=self.pool.apply_async(blockCompress,(self.codec,data))
+		self.pending.append((self.offset-len(data),len(data),result))
+		self.buf=[]
+		self.bufSize=0
+		while len(self.pending) > compressWorkers*2:
+			self.writeBlock()
+
+	def writeBlock(self):
+		offset,size,result=self.pending.popleft()
+		block=result.get()
+		self.fileObj.write(block)
+		self.blocks.append((offset,size,self.compOffset,len(block)))
+		self.compOffset+=len(block)
+
+	def close(self):
+		if self.bufSize:
+			self.compressBuf()
+		while self.pending:
+			self.writeBlock()
+		self.pool.close()
+		self.pool.join()
+		self.fileObj.close()
+
+		# The block index starts with the codec, then a line per block with
+		# its offset and size in the tar, and in the compressed file
+		with open(self.blockFile,"w") as f:
+			f.write(self.codec+"\n")
+			for block in self.blocks:
+				f.write("%d\t%d\t%d\t%d\n" % block)
+
+
+
+class BlockReader(object):
+	"""Seekable file object for tarfile which decompresses only the blocks it reads"""
+	def __init__(self,archFile,blockFile):
+		with open(blockFile,"r") as f:
+			self.codec=f.readline().strip()
+			self.blocks=[tuple(int(x) for x in line.split("\t")) for line in f]
+		self.starts=[block[0] for block in self.blocks]
+		self.size=sum(block[1] for block in self.blocks)
+		self.fileObj=open(archFile,"rb")
+		self.offset=0
+		self.cached=(None,"")
+
+	def seek(self,offset,whence=0):
+		if whence == 1:
+			offset+=self.offset
+		elif whence == 2:
+			offset+=self.size
+		self.offset=offset
+
+	def tell(self):
+		return(self.offset)
+
+	def read(self,size=-1):
+		data=[]
+		while size != 0 and self.offset < self.size:
+			i=bisect.bisect_right(self.starts,self.offset)-1
+			block=self.block(i)
+			start=self.offset-self.starts[i]
+			if size < 0:
+				chunk=block[start:]
+			else:
+				chunk=block[start:start+size]
+				size-=len(chunk)
+			data.append(chunk)
+			self.offset+=len(chunk)
+		return("".join(data))
+
+	def block(self,i):
+		# Keep the last block decompressed, since tarfile reads in small pieces
+		if self.cached[0] != i:
+			offset,size,compOffset,compSize=self.blocks[i]
+			self.fileObj.seek(compOffset)
+			self.cached=(i,blockDecompress(self.codec,self.fileObj.read(compSize)))
+		return(self.cached[1])
+
+	def close(self):
+		self.fileObj.close()
+
+
+
+class HashReader(object):
+	"""Wrap a file object so the data is hashed as tarfile reads it"""
+	def __init__(self,fileObj,digestNames=None):
+		self.fileObj=fileObj
+		self.digest=FileDigest(digestNames)
+
+	def read(self,size=-1):
+		buf=self.fileObj.read(size)
+		self.digest.update(buf)
+		return(buf)
+
+	def hexdigests(self):
+		return(self.digest.hexdigests())
+
+
+
+class TokenReader(object):
+	"""Wrap a CSV file so it is read with the columns of a --tokenize spec tokenized, as csv_hash.py writes them"""
+	def __init__(self,fileObj,spec,original=None):
+		self.spec=spec
+		lines=fileObj
+		if original is not None:
+			lines=self.hashLines(fileObj,original)
+		self.rows=csv.reader(lines,dialect='excel',delimiter=tokenDelimiter)
+		self.out=io.BytesIO()
+		self.writer=csv.writer(self.out,dialect='excel',delimiter=tokenDelimiter)
+		self.buf=""
+
+	def hashLines(self,fileObj,digest):
+		for line in fileObj:
+			digest.update(line)
+			yield(line)
+
+	def read(self,size=-1):
+		# Rows are tokenized until there is enough data for the read
+		while self.rows is not None and (size < 0 or len(self.buf)+self.out.tell() < size):
+			row=next(self.rows,None)
+			if row is None:
+				self.rows=None
+				break
+			for field in self.spec["fields"]:
+				try:
+					row[field]=csv_hash.cached_hash(row[field],self.spec["salt"],tokenMd5,self.spec["cache"])
+				except IndexError:
+					raise csv.Error("line %d has no column %d" % (self.rows.line_num,field))
+			self.writer.writerow(row)
+		if self.out.tell():
+			self.buf+=self.out.getvalue()
+			self.out.seek(0)
+			self.out.truncate()
+		if size < 0:
+			size=len(self.buf)
+		data,self.buf=self.buf[:size],self.buf[size:]
+		return(data)
+
+
+
+def tokenizeSpecs(specs):
+	"""Parse the GLOB:COLUMNS[:SALT] specs of the --tokenize options, reading the salt files as the sudo user"""
+	parsed=[]
+	if specs and len(tokenDelimiter) != 1:
+		print("The delimiter of the tokenized files must be one character.")
+		sys.exit(2030)
+	for spec in specs:
+		fields=spec.split(":",2)
+		try:
+			columns=[int(column) for column in fields[1].split(",")]
+		except (IndexError,ValueError):
+			columns=None
+		if not fields[0] or not columns:
+			print("Bad tokenize spec: "+spec+".  It is GLOB:COLUMNS[:SALT], such as '*.csv:0,3:/home/user/salt'.")
+			sys.exit(2030)
+		salt=""
+		if len(fields) > 2:
+			salt=tokenSalt(fields[2])
+		parsed.append({"glob":fields[0],"fields":columns,"salt":salt,"cache":csv_hash.cache_new(tokenCache)})
+	return(parsed)
+
+
+
+def tokenSalt(salt):
+	"""Return the salt of a --tokenize spec: the first line of the file it names, if the sudo user can read it, as csv_hash.py does, or else the string itself"""
+	os.setgroups(sudoGrps)
+	os.setegid(sudoGrps[0])
+	os.seteuid(user_to_uid(sudoUser))
 	try:
-		# Open the file and extract all files, assuming absolute paths in the tar
-		with tarfile.open(fileName,"r") as tarobj:
-			tarobj.extractall('/')
+		if os.path.isfile(salt):
+			with open(salt,'r') as f:
+				salt = f.readline().strip()
+	finally:
+		os.seteuid(0)
+		os.setegid(0)
+		os.setgroups([0])
+	return(salt)
+
+
+
+def tokenSpec(fileName):
+	"""Return the first --tokenize spec with a glob matching a file, or None.  A glob holding a / is matched against the whole path, any other against the file name"""
+	for spec in tokenSpecs:
+		name=fileName
+		if "/" not in spec["glob"]:
+			name=os.path.basename(fileName)
+		if fnmatch.fnmatchcase(name,spec["glob"]):
+			return(spec)
+	return(None)
+
+
+
+def tokenizeFiles(inventory,manifest=None):
+	"""Tokenize the files matching a --tokenize spec into tokenized{}, without writing them out.  Returns the number and size of the files"""
+	# The hardlinks of a file share the tokenized data of its first link,
+	# which is the one holding the data in the tar
+	inodes={}
+	files,size=0,0
+	for entry in metaFiles(inventory):
+		inode=None
+		if entry.stat.st_nlink > 1:
+			inode=(entry.stat.st_dev,entry.stat.st_ino)
+		if inode in inodes:
+			if inodes[inode] is not None:
+				tokenized[entry.path]=inodes[inode]
+			continue
+		token=None
+		spec=tokenSpec(entry.path)
+		# An incremental archive only takes the new and changed files
+		if spec is not None and (manifest is None or fileChanged(entry.path,manifest,{},entry.stat)):
+			try:
+				token=tokenizeFile(entry.path,spec)
+			except csv.Error as e:
+				print("Cannot tokenize "+entry.path+": "+str(e))
+				sys.exit(2040)
+			tokenized[entry.path]=token
+			files+=1
+			size+=entry.stat.st_size
+		if inode is not None:
+			inodes[inode]=token
+	return(files,size)
+
+
+
+def tokenizedKept(inventory):
+	"""Return the inventory less the original files of the tokenized files, which are kept unless --tokenize-remove is given"""
+	if not tokenSpecs or tokenizeRemove:
+		return(inventory)
+	kept=[entry for entry in metaFiles(inventory) if entry.path in tokenized or tokenSpec(entry.path) is not None]
+	if not kept:
+		return(inventory)
+	print("Kept the original files of the tokenized files, which are not in the archive: "+str(len(kept))+" (--tokenize-remove removes them)")
+	keptPaths=frozenset(entry.path for entry in kept)
+	return([entry for entry in inventory if entry.path not in keptPaths])
+
+
+
+def tokenizeFile(fileName,spec):
+	"""Tokenize a CSV file, returning the size and digests of the tokenized data and the digests of the original"""
+	# The tokens go in the cache of the spec, so the tar mostly finds them
+	# there when the file is tokenized again as it is written
+	original = FileDigest()
+	digest = FileDigest()
+	size = 0
+	with open(fileName,'rb') as f:
+		fileAdvise(f.fileno(),fadvSequential)
+		tokens = TokenReader(f,spec,original)
+		for data in iter(partial(tokens.read,hashBuffer),""):
+			digest.update(data)
+			size += len(data)
+	return({"spec":spec,"size":size,"digests":digest.hexdigests(),"original":original.hexdigests()})
+
+
+
+class invEntry(object):
+	"""An object of the inventory, with the invFields of its lstat.  It is its own stat, so entry.stat reads like an os.stat_result"""
+	__slots__=("path","top")+invFields
+
+	def __init__(self,path,fileData,top):
+		self.path=path
+		self.top=top
+		for field in invFields:
+			setattr(self,field,getattr(fileData,field))
+		for field in invSharedFields:
+			value=getattr(self,field)
+			setattr(self,field,invShared.setdefault(value,value))
+
+	@property
+	def stat(self):
+		return(self)
+
+
+
+def takeInventory(fileNameList):
+	"""Walk the files and directories in fileNameList once, returning an invEntry for every object in tar order"""
+	inventory = []
+	for fileName in fileNameList:
+		fileData = os.lstat(fileName)
+		inventory.append(invEntry(fileName,fileData,True))
+		if stat.S_ISDIR(fileData.st_mode):
+			inventory.extend(walkTree(fileName))
+	return(inventory)
+
+
+
+def scanDir(dirPath):
+	"""Return the path and lstat of every object in a directory"""
+	# scandir() takes the names and types in one call on the directory.
+	# Only the lstat is then needed for each object.
+	if scandir is not None:
+		return([(e.path,e.stat(follow_symlinks=False)) for e in scandir(dirPath)])
+	return([(os.path.join(dirPath,name),os.lstat(os.path.join(dirPath,name))) for name in os.listdir(dirPath)])
+
+
+
+def walkTree(dirPath):
+	"""Yield an invEntry for everything beneath a directory, in tar order"""
+	# The objects of a directory come first, then each subdirectory with
+	# everything beneath it.  Symlinks to directories are not followed.
+	subdirs = []
+	for path,fileData in scanDir(dirPath):
+		if stat.S_ISDIR(fileData.st_mode):
+			subdirs.append((path,fileData))
+		else:
+			yield invEntry(path,fileData,False)
+	for path,fileData in subdirs:
+		yield invEntry(path,fileData,False)
+		for entry in walkTree(path):
+			yield entry
+
+
+
+def inventoryRoots(inventory):
+	"""Yield each top level entry of the inventory, with the list of entries beneath it"""
+	root,entries = None,[]
+	for entry in inventory:
+		if entry.top:
+			if root is not None:
+				yield(root,entries)
+			root,entries = entry,[]
+		else:
+			entries.append(entry)
+	if root is not None:
+		yield(root,entries)
+
+
+
+def entryTarInfo(tarobj,entry):
+	"""Create the TarInfo of an inventory entry, as gettarinfo() does but from its lstat"""
+	fileData = entry.stat
+	mode = fileData.st_mode
+	tarinfo = tarobj.tarinfo()
+	tarinfo.tarfile = tarobj
+	tarinfo.name = entry.path.lstrip("/")
+	tarinfo.size = 0L
+	tarinfo.linkname = ""
+	if stat.S_ISREG(mode):
+		# A file with an inode already in the tar is added as a hardlink
+		inode = (fileData.st_ino,fileData.st_dev)
+		if fileData.st_nlink > 1 and inode in tarobj.inodes and tarinfo.name != tarobj.inodes[inode]:
+			tarinfo.type = tarfile.LNKTYPE
+			tarinfo.linkname = tarobj.inodes[inode]
+		else:
+			tarinfo.type = tarfile.REGTYPE
+			tarinfo.size = fileData.st_size
+			if entry.path in tokenized:
+				tarinfo.size = tokenized[entry.path]["size"]
+			if inode[0]:
+				tarobj.inodes[inode] = tarinfo.name
+	elif stat.S_ISDIR(mode):
+		tarinfo.type = tarfile.DIRTYPE
+	elif stat.S_ISFIFO(mode):
+		tarinfo.type = tarfile.FIFOTYPE
+	elif stat.S_ISLNK(mode):
+		tarinfo.type = tarfile.SYMTYPE
+		tarinfo.linkname = os.readlink(entry.path)
+	elif stat.S_ISCHR(mode):
+		tarinfo.type = tarfile.CHRTYPE
+	elif stat.S_ISBLK(mode):
+		tarinfo.type = tarfile.BLKTYPE
+	else:
+		# Sockets, which tarfile.add skips as well
+		return(None)
+
+	tarinfo.mode = mode
+	tarinfo.uid = fileData.st_uid
+	tarinfo.gid = fileData.st_gid
+	tarinfo.mtime = fileData.st_mtime
+	# The owner names come from the identity cache, instead of an NSS
+	# lookup for every member
+	tarinfo.uname = uid_to_user(fileData.st_uid) or ""
+	tarinfo.gname = gid_to_group(fileData.st_gid) or ""
+	if tarinfo.type in (tarfile.CHRTYPE,tarfile.BLKTYPE):
+		tarinfo.devmajor = os.major(fileData.st_rdev)
+		tarinfo.devminor = os.minor(fileData.st_rdev)
+	return(tarinfo)
+
+
+
+def tarMembers(tarobj,entries):
+	"""Yield (entry,tarinfo) for every inventory entry to be added to the tar"""
+	# Skip the tar, its volumes and the files next to it if they are inside
+	# one of the directories being archived
+	archStem = archiveStem(tarobj.name)
+	root = None
+	for entry in entries:
+		if entry.top:
+			if root is not None:
+				print("Completed: "+root)
+			root = entry.path
+
+		if tarExclude(entry.path) or entry.path.startswith(archStem):
+			continue
+		tarinfo = entryTarInfo(tarobj,entry)
+		if tarinfo is None:
+			continue
+		yield(entry,tarinfo)
+	if root is not None:
+		print("Completed: "+root)
+
+
+
+def addMember(tarobj,tarinfo,fileObj=None):
+	"""Add a member to the tar, returning the offsets of its header and data"""
+	headerOffset = tarobj.offset
+	tarobj.addfile(tarinfo,fileObj)
+	dataOffset = tarobj.offset
+	if fileObj is not None:
+		dataOffset -= ((tarinfo.size+tarfile.BLOCKSIZE-1)//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+	return(headerOffset,dataOffset)
+
+
+
+def addFile(tarobj,tarinfo,fileName,fileData,digestNames=None):
+	"""Add a regular file to the tar, returning the offsets of its header and data, and a dict of its digests"""
+	token = tokenized.get(fileName)
+	with open(fileName,'rb') as f:
+		fileAdvise(f.fileno(),fadvSequential)
+		extents = None
+		if token is None and sparseFile(fileData):
+			extents = fileExtents(f.fileno(),tarinfo.size)
+		if token is not None:
+			offsets,fileDigests = addTokenized(tarobj,tarinfo,f,token,digestNames)
+		elif extents is not None:
+			offsets,fileDigests = addSparse(tarobj,tarinfo,f,extents,digestNames)
+		else:
+			# The HashReader feeds the digests with the same buffers
+			# written to the tar
+			reader = HashReader(f,digestNames)
+			offsets = addMember(tarobj,tarinfo,reader)
+			fileDigests = reader.hexdigests()
+		if tarinfo.size >= hashDropMin:
+			fileAdvise(f.fileno(),fadvDontNeed)
+	return(offsets,fileDigests)
+
+
+
+def addTokenized(tarobj,tarinfo,fileObj,token,digestNames=None):
+	"""Add a CSV file to the tar with the columns of its --tokenize spec tokenized, returning the offsets of its header and data, and a dict of the digests of the tokenized data"""
+	# The size in the header and the id in the metadata are those found by
+	# tokenizeFiles(), so the data must still be the same
+	tokens = TokenReader(fileObj,token["spec"])
+	reader = HashReader(tokens,digestNames)
+	offsets = addMember(tarobj,tarinfo,reader)
+	fileDigests = reader.hexdigests()
+	if fileDigests[idDigest] != token["digests"][idDigest] or tokens.read(1):
+		print("File changed after it was tokenized: "+fileObj.name)
+		raise IOError("File changed after it was tokenized: "+fileObj.name)
+	return(offsets,fileDigests)
+
+
+
+def addSparse(tarobj,tarinfo,fileObj,extents,digestNames=None):
+	"""Add a file with holes to the tar as a GNU sparse member holding only its data extents"""
+	# tarfile can read sparse members but not write them, so the headers
+	# and data are written here as TarFile.addfile() would
+	headerOffset = tarobj.offset
+	buf = sparseHeader(tarobj,tarinfo,extents)
+	tarobj.fileobj.write(buf)
+	tarobj.offset += len(buf)
+	dataOffset = tarobj.offset
+
+	digest = FileDigest(digestNames)
+	position = 0
+	for offset,length in extents:
+		hashZeros(digest,offset-position)
+		fileObj.seek(offset)
+		remaining = length
+		while remaining > 0:
+			data = fileObj.read(min(remaining,1048576))
+			if not data:
+				raise IOError("Unexpected end of data in "+fileObj.name)
+			digest.update(data)
+			tarobj.fileobj.write(data)
+			remaining -= len(data)
+		position = offset+length
+
+	blocks,remainder = divmod(sum([length for offset,length in extents]),tarfile.BLOCKSIZE)
+	if remainder > 0:
+		tarobj.fileobj.write(tarfile.NUL*(tarfile.BLOCKSIZE-remainder))
+		blocks += 1
+	tarobj.offset += blocks*tarfile.BLOCKSIZE
+	tarobj.members.append(tarinfo)
+	return((headerOffset,dataOffset),digest.hexdigests())
+
+
+
+def sparseHeader(tarobj,tarinfo,extents):
+	"""Return the GNU sparse header of a member, followed by the extension blocks holding the rest of its extents"""
+	# The header holds 4 extents and each extension block 21, as (offset,
+	# length) pairs of 12 byte numbers.  The size of the member is the size
+	# of the data stored, and the size of the file is in its realsize field.
+	header = copy.copy(tarinfo)
+	header.type = tarfile.GNUTYPE_SPARSE
+	header.size = sum([length for offset,length in extents])
+	buf = header.tobuf(tarfile.GNU_FORMAT,tarobj.encoding,tarobj.errors)
+	fields = [tarfile.itn(offset,12,tarfile.GNU_FORMAT)+tarfile.itn(length,12,tarfile.GNU_FORMAT) for offset,length in extents]
+
+	block = buf[-tarfile.BLOCKSIZE:]
+	block = block[:386]+"".join(fields[:4]).ljust(96,tarfile.NUL)+chr(int(len(fields) > 4))+tarfile.itn(tarinfo.size,12,tarfile.GNU_FORMAT)+block[495:]
+	block = block[:148]+" "*8+block[156:]
+	block = block[:148]+"%06o\0" % tarfile.calc_chksums(block)[0]+block[155:]
+
+	extensions = []
+	for i in xrange(4,len(fields),21):
+		extensions.append("".join(fields[i:i+21]).ljust(504,tarfile.NUL)+chr(int(i+21 < len(fields)))+tarfile.NUL*7)
+	return(buf[:-tarfile.BLOCKSIZE]+block+"".join(extensions))
+
+
+
+def tocCreate(archFile):
+	"""Create the empty table of contents for an archive"""
+	return(anydbm.open(archiveStem(archFile)+archiveTocExt,"n"))
+
+
+
+def tocWrite(toc,tarinfo,offsets,fileHash=""):
+	"""Record the offsets, size and hash of a member in the table of contents"""
+	toc[tarinfo.name] = "%d\t%d\t%d\t%s" % (offsets[0],offsets[1],tarinfo.size,fileHash)
+
+
+
+def tocEntry(toc,member):
+	"""Return the table of contents entry of a member as a dict, False if not found"""
+	member = member.lstrip("/")
+	if not toc.has_key(member):
+		return(False)
+	headerOffset,dataOffset,size,fileHash = toc[member].split("\t")
+	return({"name":member,"header_offset":int(headerOffset),"data_offset":int(dataOffset),"size":int(size),"sha1":fileHash})
+
+
+
+def tocMember(tarobj,entry):
+	"""Read the TarInfo of a member by seeking straight to its header"""
+	tarobj.fileobj.seek(entry["header_offset"])
+	tarobj.offset = entry["header_offset"]
+	return(tarfile.TarInfo.fromtarfile(tarobj))
+
+
+
+def tocList(archFile):
+	"""Print the size, SHA1 and name of every member of an archive"""
+	toc = anydbm.open(archiveStem(archFile)+archiveTocExt,"r")
+	try:
+		for member in sorted(toc.keys()):
+			entry = tocEntry(toc,member)
+			print("%12d %40s /%s" % (entry["size"],entry["sha1"],member))
+	finally:
+		toc.close()
+
+
+
+def tocStat(archFile,members):
+	"""Print the details of members of an archive, found through its table of contents"""
+	toc = anydbm.open(archiveStem(archFile)+archiveTocExt,"r")
+	try:
+		with openArchive(archFile) as tarobj:
+			for member in members:
+				entry = tocEntry(toc,member)
+				if not entry:
+					print("Not in archive: "+member)
+					continue
+				tarinfo = tocMember(tarobj,entry)
+				print("Name: /"+tarinfo.name)
+				print("Owner: %s:%s (%d:%d)" % (tarinfo.uname,tarinfo.gname,tarinfo.uid,tarinfo.gid))
+				print("Mode: "+oct(tarinfo.mode)[-3:])
+				print("Mtime: "+time8601(tarinfo.mtime))
+				print("Size: "+str(entry["size"]))
+				print("SHA1: "+entry["sha1"])
+				print("Offsets: header %d, data %d" % (entry["header_offset"],entry["data_offset"]))
+	finally:
+		toc.close()
+
+
+
+def tocExtract(archFile,members,path="/"):
+	"""Extract members of an archive, seeking to them through its table of contents"""
+	toc = anydbm.open(archiveStem(archFile)+archiveTocExt,"r")
+	refArchives = {}
+	try:
+		with openArchive(archFile) as tarobj:
+			for member in members:
+				entry = tocEntry(toc,member)
+				if not entry:
+					print("Not in archive: "+member)
+					sys.exit(8010)
+				tarinfo = tocMember(tarobj,entry)
+				if tarinfo.issparse():
+					restoreSparse(tarobj,tarinfo,path)
+				else:
+					tarobj.extract(tarinfo,path)
+				# Dedup references were extracted empty, copy the data in
+				if "CFS.ref" in tarinfo.pax_headers:
+					resolveRef(tarobj,tarinfo,refArchives)
+				print("Restored: /"+tarinfo.name)
+	finally:
+		for refobj in refArchives.values():
+			refobj.close()
+		toc.close()
+
+
+
+def archObj(inventory,archPath,mnt,client,manifest=None,changed=None,publisher=None,journal=None):
+	"""Hash, tar and create the metadata for a file or directory in one read"""
+	# Same privilege handling as tarObj(), the tar is created as root
+	os.setuid(0)
+	os.setgid(0)
+
+	archFile = os.path.join(archPath,fileStamp+archiveExt)
+	metaFile = os.path.join(archPath,fileStamp+archiveMetaExt)
+	metaFh = metaOpen(metaFile,journal and journal["meta_offset"])
+
+	try:
+		toc = tocOpen(archFile,journal)
+		archFh = archiveOpen(archFile,journal)
+		with tarfile.open(archFile,mode="w",fileobj=archFh) as tarobj:
+			# Unchanged files are left out of an incremental archive, and the
+			# members already in the journal out of a resumed one
+			entries = journalEntries(inventory,journal)
+			if manifest is not None:
+				entries = changedEntries(entries,manifest,changed)
+			members = tarMembers(tarobj,entries)
+			archMembers(tarobj,toc,metaFh,members,archFile,mnt,client,changed,publisher,journal)
 			tarobj.close()
+			archFh.close()
+			toc.close()
+			print("Archive file: "+archFile)
+
+	except:
+		print("Error creating the archive")
+		sys.exit(5010)
+
+	# Close the "add" element of the metaFile
+	metaClose(metaFh)
+	return(True)
+
+
+
+def archMembers(tarobj,toc,metaFh,members,archFile,mnt,client,changed=None,publisher=None,journal=None):
+	"""Add (entry,tarinfo) members to a tar, hashing each file as it is written"""
+	# The digests of the files with several hardlinks, by member name, for
+	# the hardlink members which refer to them
+	linkHashes = {}
+	for entry,tarinfo in members:
+		fileName = entry.path
+		fileDigests = None
+		if tarinfo.isreg():
+			# The only read of the file, hashed as it is written to the tar
+			offsets,fileDigests = addFile(tarobj,tarinfo,fileName,entry.stat)
+			if entry.stat.st_nlink > 1:
+				linkHashes[tarinfo.name] = fileDigests
+		else:
+			offsets = addMember(tarobj,tarinfo)
+			# A hardlink holds the same data as the member it links to
+			if tarinfo.islnk():
+				fileDigests = linkHashes.get(tarinfo.linkname)
+		fileHash = ""
+		if fileDigests is not None:
+			fileHash = fileDigests[idDigest]
+		tocWrite(toc,tarinfo,offsets,fileHash)
+
+		if fileDigests is not None:
+			if changed is not None:
+				changed[fileName] += "\t"+fileHash+"\t"+archFile
+
+			fileDict = fileMeta(fileName,fileDigests,archFile,mnt,client,entry.stat)
+			metaWrite(metaFh,fileDict)
+			if publisher is not None:
+				publishDoc(publisher,fileDict)
+			# The XML is flushed with each journal line, so a stopped job
+			# only loses the members still in the buffer of the tar
+			if journal is not None:
+				metaFh.flush()
+		journalMember(journal,tarobj,tarinfo,offsets,fileHash,metaFh.tell())
+
+
+
+def volumeFile(archPath,volume):
+	"""Return the name of a volume of the archive"""
+	return(os.path.join(archPath,fileStamp+volumeTag % volume+archiveExt))
+
+
+
+def memberSize(tarobj,tarinfo):
+	"""Return the bytes a member takes in the tar, its header blocks and padded data"""
+	size = len(tarinfo.tobuf(tarobj.format,tarobj.encoding,tarobj.errors))
+	if tarinfo.isreg():
+		size += ((tarinfo.size+tarfile.BLOCKSIZE-1)//tarfile.BLOCKSIZE)*tarfile.BLOCKSIZE
+	return(size)
+
+
+
+def planVolumes(inventory,archPath,manifest=None,changed=None):
+	"""Yield the members of each volume as a list, each list under volumeSize bytes of tar"""
+	# The TarInfos are created on a tar that is never written, so the
+	# hardlinks are found across the whole set, and not only in one volume.
+	tarobj = tarfile.open(os.path.join(archPath,fileStamp+archiveExt),mode="w",fileobj=io.BytesIO())
+	entries = inventory
+	if manifest is not None:
+		entries = changedEntries(entries,manifest,changed)
+
+	# Leave room for the end of archive blocks and the padding to a whole
+	# record.  A file larger than a volume is given a volume of its own.
+	# A file and its hardlinks are kept in one volume, so each volume holds
+	# the data its hardlinks refer to and can be restored on its own.
+	limit = volumeSize-tarfile.RECORDSIZE-2*tarfile.BLOCKSIZE
+	volume,size = [],0
+	for unit in volumeUnits(tarMembers(tarobj,linkGroups(entries))):
+		tarSize = sum([memberSize(tarobj,tarinfo) for entry,tarinfo in unit])
+		if volume and size+tarSize > limit:
+			yield(volume)
+			volume,size = [],0
+		volume.extend(unit)
+		size += tarSize
+	if volume:
+		yield(volume)
+
+
+
+def linkKey(entry):
+	"""Return the inode of a regular file with several hardlinks, or None"""
+	if stat.S_ISREG(entry.stat.st_mode) and entry.stat.st_nlink > 1:
+		return((entry.stat.st_dev,entry.stat.st_ino))
+	return(None)
+
+
+
+def linkGroups(entries):
+	"""Yield the inventory entries, with the other links of a file with several hardlinks moved up after its first link"""
+	entries = list(entries)
+	links = {}
+	for entry in entries:
+		key = linkKey(entry)
+		if key is not None:
+			links.setdefault(key,[]).append(entry)
+	for entry in entries:
+		key = linkKey(entry)
+		if key is None:
+			yield(entry)
+		elif key in links:
+			for link in links.pop(key):
+				yield(link)
+
+
+
+def volumeUnits(members):
+	"""Group (entry,tarinfo) members into the units kept in one volume: a file with its hardlinks, or a single member"""
+	unit,unitKey = [],None
+	for entry,tarinfo in members:
+		key = linkKey(entry)
+		if unit and (key is None or key != unitKey):
+			yield(unit)
+			unit = []
+		unit.append((entry,tarinfo))
+		unitKey = key
+	if unit:
+		yield(unit)
+
+
+
+def volObj(volume,volFile,mnt,client,changed=None,publisher=None):
+	"""Write one volume of the archive with its table of contents and metadata, run on the volume threads"""
+	metaFh = metaOpen(archiveStem(volFile)+archiveMetaExt)
+	toc = tocCreate(volFile)
+	archFh = archiveCreate(volFile)
+	with tarfile.open(volFile,mode="w",fileobj=archFh) as tarobj:
+		archMembers(tarobj,toc,metaFh,volume,volFile,mnt,client,changed,publisher)
+		tarobj.close()
+	archFh.close()
+	toc.close()
+	metaClose(metaFh)
+	print("Archive file: "+volFile)
+	return(volFile)
+
+
+
+def volArch(inventory,archPath,mnt,client,manifest=None,changed=None,publisher=None):
+	"""Hash, tar and create the metadata for a file or directory as a set of volumes"""
+	# Same privilege handling as tarObj(), the volumes are created as root
+	os.setuid(0)
+	os.setgid(0)
+
+	# Each volume is handed to the pool as soon as it is planned, and only a
+	# few are planned ahead of the writers, so the TarInfos held in memory
+	# stay bounded for any size of archive.
+	pool = ThreadPool(volumeWorkers)
+	pending = collections.deque()
+	volFiles = []
+	try:
+		for volume in planVolumes(inventory,archPath,manifest,changed):
+			volFile = volumeFile(archPath,len(volFiles)+len(pending)+1)
+			pending.append(pool.apply_async(volObj,(volume,volFile,mnt,client,changed,publisher)))
+			if len(pending) >= volumeWorkers*2:
+				volFiles.append(pending.popleft().get())
+		while pending:
+			volFiles.append(pending.popleft().get())
+	except:
+		print("Error creating the archive volumes")
+		sys.exit(5020)
+	finally:
+		pool.terminate()
+		pool.join()
+
+	# The set file is only written once every volume is complete
+	setFile = os.path.join(archPath,fileStamp+archiveSetExt)
+	with open(setFile,"w") as f:
+		for volFile in volFiles:
+			f.write(volFile+"\n")
+	print("Archive set: "+setFile+" ("+str(len(volFiles))+" volumes)")
+	return(True)
+
+
+
+def archiveVolumes(fileName):
+	"""Return the volumes of the set an archive belongs to, or the archive alone"""
+	if fileName.endswith(archiveSetExt):
+		setFile = fileName
+	else:
+		setFile = re.sub(r"\.vol[0-9]+$","",archiveStem(fileName))+archiveSetExt
+	if not os.path.exists(setFile):
+		return([fileName])
+	with open(setFile,"r") as f:
+		volFiles = [line.strip() for line in f if line.strip()]
+
+	missing = [volFile for volFile in volFiles if not os.path.exists(volFile)]
+	if missing:
+		print("Missing volumes: "+", ".join(missing))
+		sys.exit(8020)
+	return(volFiles)
+
+
+
+def unTarObj(fileName,members=None):
+	"""unTar a file or directory, only the members matching the members globs if given"""
+	# An archive written in volumes is restored from the whole set
+	volFiles = archiveVolumes(fileName)
+	tarobjs = []
+	try:
+		# Open the volumes and collect the members to extract, assuming
+		# absolute paths in the tar.  The members of all the volumes are
+		# kept in the order of the set, as they were found when archiving.
+		dirs,files,others,batches = [],[],[],[]
+		for volFile in volFiles:
+			tarobj = openArchive(volFile)
+			tarobjs.append(tarobj)
+			tarinfos = restoreMembers(tarobj,volFile,members)
+			dirs.extend([(tarobj,t) for t in tarinfos if t.isdir()])
+			others.extend([(tarobj,t) for t in tarinfos if not t.isdir() and not t.isreg()])
+			volInfos = [t for t in tarinfos if t.isreg()]
+			files.extend(volInfos)
+			batches.append([(volFile,volInfos[i:i+restoreBatch]) for i in range(0,len(volInfos),restoreBatch)])
+
+		# As extractall() does, create the directories with a safe mode
+		# first, and set their permissions once the files are in them.
+		for tarobj,tarinfo in dirs:
+			safeinfo = copy.copy(tarinfo)
+			safeinfo.mode = 0700
+			tarobj.extract(safeinfo,'/')
+
+		# The parents of the files must exist before the threads start,
+		# or they race each other creating them.
+		for tarinfo in files+[t for tarobj,t in others]:
+			upperdirs = os.path.dirname(os.path.join('/',tarinfo.name))
+			if not os.path.isdir(upperdirs):
+				os.makedirs(upperdirs)
+
+		# Write the files on the thread pool.  The batches of the volumes
+		# are taken in turn, so the volumes are read in parallel.  Files
+		# stored as dedup references are copied in from the archives
+		# holding their data.
+		batches = [b for turn in itertools.izip_longest(*batches) for b in turn if b is not None]
+		pool = ThreadPool(restoreWorkers)
+		try:
+			for batch in pool.imap_unordered(restoreBatchFiles,batches):
+				pass
+		finally:
+			pool.terminate()
+			pool.join()
+
+		# Links last, since they can point to any of the files
+		for tarobj,tarinfo in others:
+			tarobj.extract(tarinfo,'/')
+
+		# Reverse sort the directories, so the deepest are set first
+		dirs.sort(key=lambda a: a[1].name)
+		dirs.reverse()
+		for tarobj,tarinfo in dirs:
+			dirpath = os.path.join('/',tarinfo.name)
+			tarobj.chown(tarinfo,dirpath)
+			tarobj.utime(tarinfo,dirpath)
+			tarobj.chmod(tarinfo,dirpath)
+
+		print("Restored: "+str(len(dirs)+len(files)+len(others))+" objects from "+fileName)
 	except:
 		raise
+	finally:
+		for tarobj in tarobjs:
+			tarobj.close()
+
+
+
+def memberMatch(name,members):
+	"""Determine if a member name matches one of the members globs, or is under one"""
+	if not members:
+		return(True)
+	for member in members:
+		member = member.strip("/")
+		if fnmatch.fnmatchcase(name,member) or name.startswith(member+"/"):
+			return(True)
+	return(False)
 
 
 
-def rmFiles(fileNameList,archPath):
+def restoreMembers(tarobj,fileName,members):
+	"""Return the TarInfo of each member to restore, in the order of the tar"""
+	# With a table of contents, only the headers of the matching members are
+	# read.  Older archives without one are read from the start.
+	try:
+		toc = anydbm.open(archiveStem(fileName)+archiveTocExt,"r")
+	except anydbm.error:
+		return([t for t in tarobj if memberMatch(t.name,members)])
+
+	try:
+		entries = [tocEntry(toc,name) for name in toc.keys() if memberMatch(name,members)]
+	finally:
+		toc.close()
+	entries.sort(key=lambda a: a["header_offset"])
+	return([tocMember(tarobj,entry) for entry in entries])
+
+
+
+def restoreBatchFiles(batch):
+	"""Extract a (fileName,tarinfos) batch of files, run on the restore threads"""
+	return(restoreFiles(*batch))
+
+
+
+def restoreFiles(fileName,tarinfos):
+	"""Extract a batch of files with a tar handle of their own, run on the restore threads"""
+	refArchives = {}
+	with openArchive(fileName) as tarobj:
+		try:
+			for tarinfo in tarinfos:
+				if tarinfo.issparse():
+					restoreSparse(tarobj,tarinfo,'/')
+				else:
+					tarobj.extract(tarinfo,'/')
+				# Files stored as dedup references were extracted empty, so
+				# copy their data in from the archives holding it.
+				if "CFS.ref" in tarinfo.pax_headers:
+					resolveRef(tarobj,tarinfo,refArchives)
+		finally:
+			for refobj in refArchives.values():
+				refobj.close()
+	return(len(tarinfos))
+
+
+
+def restoreSparse(tarobj,tarinfo,path):
+	"""Extract a sparse member, seeking over the zero blocks instead of writing them, so its holes are kept"""
+	# tarfile reads the holes back as zeros.  Each 4KB block of zeros is
+	# skipped, the size of a filesystem block.
+	target = os.path.join(path,tarinfo.name)
+	if not os.path.isdir(os.path.dirname(target)):
+		os.makedirs(os.path.dirname(target))
+	source = tarobj.extractfile(tarinfo)
+	with open(target,"wb") as f:
+		for chunk in iter(partial(source.read,1048576),""):
+			if chunk.count(tarfile.NUL) == len(chunk):
+				f.seek(len(chunk),os.SEEK_CUR)
+				continue
+			for i in xrange(0,len(chunk),4096):
+				block = chunk[i:i+4096]
+				if block.count(tarfile.NUL) == len(block):
+					f.seek(len(block),os.SEEK_CUR)
+				else:
+					f.write(block)
+		f.truncate(tarinfo.size)
+	tarobj.chown(tarinfo,target)
+	tarobj.chmod(tarinfo,target)
+	tarobj.utime(tarinfo,target)
+
+
+
+def resolveRef(tarobj,tarinfo,refArchives):
+	"""Restore the data of a deduplicated file from the archive that holds it"""
+	refFile,refName = tarinfo.pax_headers["CFS.ref"].encode("utf-8").split("\t",1)
+	if refFile not in refArchives:
+		refArchives[refFile] = openArchive(refFile)
+
+	# Copy the data over the empty file, checking it against the stored hash
+	target = os.path.join("/",tarinfo.name)
+	digestName = str(tarinfo.pax_headers.get("CFS.digest","sha1"))
+	reader = HashReader(refArchives[refFile].extractfile(refName),[digestName])
+	with open(target,"wb") as f:
+		shutil.copyfileobj(reader,f,1048576)
+	if reader.hexdigests()[digestName] != tarinfo.pax_headers["CFS.sha1"]:
+		print("Checksum mismatch restoring "+target+" from "+refFile)
+		sys.exit(8000)
+
+	# Writing the data changed the mtime, so set the ownership, permissions
+	# and times from the member again.
+	tarobj.chown(tarinfo,target)
+	tarobj.chmod(tarinfo,target)
+	tarobj.utime(tarinfo,target)
+
+
+
+def rmFiles(inventory,archPath):
 	"""Remove the original files after they have been archived"""
 	# Set a local variable for the person who executed the script
 	sudoID=user_to_uid(sudoUser)
 	
-	for fileName in fileNameList:
+	for root,entries in inventoryRoots(inventory):
+		fileName=root.path
 		# Let's be certain who we are ... set user/group to root
 		os.setuid(0)
 		os.setgid(0)
 
 		# Get the group ownership of the file in question
-		groupID=os.stat(fileName)[5]
+		groupID=root.stat.st_gid
 
 		# Check to see if the original user is in the group
 		if userInGrp(sudoID,groupID) == True:
@@ -461,7 +2517,7 @@ def rmFiles(fileNameList,archPath):
 			sys.exit(7003)
 			
 		# Test if fileName is a file
-		elif os.path.isfile(fileName):
+		elif stat.S_ISREG(root.stat.st_mode):
 			try:
 				os.remove(fileName)
 			except OSError:
@@ -469,10 +2525,16 @@ def rmFiles(fileNameList,archPath):
 				raise
 				sys.exit(7002)
 
-		# Test if fileName is a directory
-		elif os.path.isdir(fileName):
+		# Test if fileName is a directory.  Only the objects in the inventory
+		# are removed, deepest first, so a directory holding files created
+		# after the archive was taken is left in place.
+		elif stat.S_ISDIR(root.stat.st_mode):
+			# A mount point beneath the directory is on another device
+			if any(entry.stat.st_dev != root.stat.st_dev for entry in entries):
+				print("Cannot remove a mount point!")
+				sys.exit(7003)
 			try:
-				shutil.rmtree(fileName)
+				rmTree(root,entries)
 			except OSError:
 				print("Error removing directory")
 				raise
@@ -486,11 +2548,94 @@ def rmFiles(fileNameList,archPath):
 
 
 
-def checkPerm(fileNameList):
+def rmTree(root,entries):
+	"""Remove a directory and the inventory entries beneath it on the removal threads"""
+	# The files and links are grouped by the directory holding them, so each
+	# thread unlinks in a directory of its own, rmBatch files at a time.
+	# The directories are grouped by depth, to be removed bottom-up.
+	dirFiles,levels = {},{}
+	for entry in entries:
+		if stat.S_ISDIR(entry.stat.st_mode):
+			levels.setdefault(entry.path.count("/"),[]).append(entry.path)
+		else:
+			dirFiles.setdefault(os.path.dirname(entry.path),[]).append(entry.path)
+	batches = [paths[i:i+rmBatch] for paths in dirFiles.values() for i in range(0,len(paths),rmBatch)]
+
+	progress = {"files":0,"dirs":0,"start":time.time(),"last":time.time()}
+	pool = ThreadPool(rmWorkers)
+	try:
+		for count in pool.imap_unordered(removeFiles,batches):
+			progress["files"] += count
+			removeProgress(progress)
+
+		# The directories of one level are not beneath each other, so each
+		# level is removed in parallel as well, the deepest level first.
+		for depth in sorted(levels,reverse=True):
+			paths = levels[depth]
+			for count in pool.imap_unordered(removeDirs,[paths[i:i+rmBatch] for i in range(0,len(paths),rmBatch)]):
+				progress["dirs"] += count
+				removeProgress(progress)
+	finally:
+		pool.terminate()
+		pool.join()
+
+	if removeDir(root.path):
+		progress["dirs"] += 1
+	removeProgress(progress,True)
+
+
+
+def removeFiles(paths):
+	"""Unlink a batch of files, run on the removal threads"""
+	for path in paths:
+		os.remove(path)
+	return(len(paths))
+
+
+
+def removeDirs(paths):
+	"""Remove a batch of empty directories, run on the removal threads, returning the number removed"""
+	removed = 0
+	for path in paths:
+		if removeDir(path):
+			removed += 1
+	return(removed)
+
+
+
+def removeDir(path):
+	"""Remove a directory, leaving it in place if it holds objects which were not archived"""
+	try:
+		os.rmdir(path)
+	except OSError as e:
+		if e.errno not in (errno.ENOTEMPTY,errno.EEXIST):
+			raise
+		print("Not empty, left in place: "+path)
+		return(False)
+	return(True)
+
+
+
+def removeProgress(progress,done=False):
+	"""Print the removal progress every rmReport seconds, and once it is done"""
+	now = time.time()
+	if not done and now-progress["last"] < rmReport:
+		return
+	progress["last"] = now
+	rate = progress["files"]/max(now-progress["start"],0.001)
+	print("Removed: %d files, %d directories (%.0f files/sec)" % (progress["files"],progress["dirs"],rate))
+	# The wrapper sends the output to archive.out, so flush each report
+	sys.stdout.flush()
+
+
+
+def checkPerm(inventory):
 	"""Drop permissions and check user is allowed to access files"""
 	sudoID=user_to_uid(sudoUser)
 
-	for fileName in fileNameList:
+	for root,entries in inventoryRoots(inventory):
+		fileName=root.path
+		fileData=root.stat
 		os.setuid(0)
 		os.setgid(0)
 		os.setgroups([0])
@@ -504,8 +2649,8 @@ def checkPerm(fileNameList):
 		# Check to see if the object desired for archive is a directory
 		# If it is a directory, pythonically attempt to create a file in
 		# the directory to determine permission access.
-		elif os.path.isdir(fileName):
-			groupID=os.stat(fileName)[5]
+		elif stat.S_ISDIR(fileData.st_mode):
+			groupID=fileData.st_gid
 
 			if userInGrp(sudoID,groupID) == True:
 				# Downgrade the user perms to the sudo user who instantiated the process
@@ -516,7 +2661,7 @@ def checkPerm(fileNameList):
 			os.seteuid(sudoID)
 
 
-			if os.stat(fileName).st_uid == sudoID or os.stat(fileName).st_gid in sudoGrps:
+			if fileData.st_uid == sudoID or fileData.st_gid in sudoGrps:
 			
 				try:
 					# Create the test file inside the target directory
@@ -546,18 +2691,17 @@ def checkPerm(fileNameList):
 						# Set the uid of the program back to root
 						os.setuid(0)
 						os.setgid(0)
-						# All tests passed, return validation to calling function/process
+						# The directory passed, go on to the next object
 						#print("Access Granted")
-						return(True)
 			else:
 				print("You do not own the directory, and are not in the group")
 				sys.exit(1050)
 
 
 		# Check to see if  the object desired for archive is a file
-		elif os.path.isfile(fileName):
+		elif stat.S_ISREG(fileData.st_mode):
 
-			groupID=os.stat(fileName)[5]
+			groupID=fileData.st_gid
 			if userInGrp(sudoID,groupID) == True:
 				# Downgrade the user perms to the sudo user who instantiated the process
 				os.setegid(groupID)
@@ -586,23 +2730,616 @@ def checkPerm(fileNameList):
 					# Set the uid of the program back to root
 					os.setuid(0)
 					os.setgid(0)
-					# All tests passed, return validation to calling function/process
+					# The file passed, go on to the next object
 					#print("Access Granted")
-					return(True)
 
 		# The target for archive isn't a dir, file or mount, so exit immediately
 		else:
 			print("Object type not handled")
 			sys.exit(1001)
 
+	# Every top level object passed, now check everything beneath them.
+	# The originals are only removed when the archive is not incremental.
+	os.setuid(0)
+	os.setgid(0)
+	os.setgroups([0])
+	return(verifyTree(inventory,not opts.incremental_var))
+
+
+
+def verifyTree(inventory,removing=True):
+	"""Check the sudo user can read every file and write every directory, with one report of the denials"""
+	sudoID=user_to_uid(sudoUser)
+	denied=[]
+	checked=0
+
+	pool=ThreadPool(permWorkers)
+	try:
+		for root,entries in inventoryRoots(inventory):
+			# Read access to the files, and write access to the directories,
+			# so the files can be tarred and then removed.  Removing a top
+			# level object needs write access to the directory holding it.
+			checks=[(e.path,accessMode(e)) for e in [root]+entries if accessMode(e)]
+			if removing:
+				checks.append((os.path.dirname(root.path),os.W_OK|os.X_OK))
+			checked+=len(checks)
+
+			# Same identity as the checks of the top level objects above
+			groupID=root.stat.st_gid
+			if userInGrp(sudoID,groupID) != True:
+				groupID=1000
+
+			# access() checks the real ids, so the real ids are dropped to
+			# the sudo user while the saved ids are kept as root
+			os.setgroups(sudoGrps)
+			os.setresgid(groupID,groupID,0)
+			os.setresuid(sudoID,sudoID,0)
+			try:
+				batches=[checks[i:i+permBatch] for i in range(0,len(checks),permBatch)]
+				for result in pool.imap_unordered(accessCheck,batches):
+					denied.extend(result)
+			finally:
+				os.setresuid(0,0,0)
+				os.setresgid(0,0,0)
+				os.setgroups([0])
+	finally:
+		pool.terminate()
+		pool.join()
+
+	# One report for the whole tree, listing the first permReportMax denials
+	print("Permission check: "+str(checked)+" objects checked, "+str(len(denied))+" denied")
+	for path,mode in sorted(denied)[:permReportMax]:
+		if mode & os.W_OK:
+			print("Denied write: "+path)
+		else:
+			print("Denied read: "+path)
+	if len(denied) > permReportMax:
+		print("... and "+str(len(denied)-permReportMax)+" more")
+	if denied:
+		sys.exit(1060)
 	return(True)
 
 
 
+def accessMode(entry):
+	"""Return the access needed to archive and remove an inventory entry, 0 if none is checked"""
+	if stat.S_ISREG(entry.stat.st_mode):
+		return(os.R_OK)
+	elif stat.S_ISDIR(entry.stat.st_mode):
+		return(os.R_OK|os.W_OK|os.X_OK)
+	# Links and special files are not read, and are removed through the
+	# access to their directory
+	return(0)
+
+
+
+def accessCheck(checks):
+	"""Return the (path,mode) checks which failed, run on the permission threads"""
+	return([(path,mode) for path,mode in checks if not os.access(path,mode)])
+
+
+
+def archiveFiles(fileList,objPath,journal=None):
+	"""Check permissions, then hash, tar and remove the files in fileList"""
+	with jobPhase("findMount"):
+		mnt,remainder,client=findMount(os.path.realpath(os.path.normpath(os.path.abspath(objPath))))
+		archPath=os.path.join(mnt,client,archiveDir,str(tdy.year).zfill(2),str(tdy.month).zfill(2))
+
+	try:
+		os.makedirs(archPath,0700)
+	except OSError:
+		pass
+
+	# Walk and stat the fileList once.  The permission check, the hashing,
+	# the tar and the removal all work from this inventory.
+	with jobPhase("inventory") as phase:
+		inventory=takeInventory(fileList)
+		files,size=inventoryTotals(inventory)
+		phase["files"]=len(inventory)
+
+	with jobPhase("checkPerm") as phase:
+		phase["files"]=len(inventory)
+		permitted=checkPerm(inventory)
+
+	if permitted == True:
+		# Set the uid of the program back to root, just in case
+		os.setuid(0)
+		os.setgid(0)
+
+		# An incremental archive compares the files against the manifest of
+		# the earlier runs, and records the files it archived in changed{}.
+		manifest,changed=None,None
+		if opts.incremental_var:
+			manifestFile=os.path.join(mnt,client,archiveDir,incrManifest)
+			manifest,changed=openIndex(manifestFile),{}
+
+		# The files matching a --tokenize spec are tokenized before anything
+		# is written, so a file which is not valid CSV stops the job here.
+		if tokenSpecs:
+			with jobPhase("tokenize") as phase:
+				phase["files"],phase["bytes"]=tokenizeFiles(inventory,manifest)
+			print("Tokenized files: "+str(phase["files"]))
+
+		# The journal of the job, unless it is being resumed from one.  The
+		# metadata of a resumed job is published once it is complete, since
+		# the docs published before the stop may not have been committed.
+		if journal is None:
+			journal=journalCreate(os.path.join(archPath,fileStamp+archiveJournalExt),jobHeader(fileList,objPath))
+		resumed=journal["offset"] is not None or journal["meta"]
+		metaFile=os.path.join(archPath,fileStamp+archiveMetaExt)
+
+		# Dedup needs every hash before the tar is written, which the single
+		# pass cannot provide.
+		if opts.single_pass_var and opts.dedup_var:
+			print("Dedup needs the hashes before tarring, not using the single pass.")
+		if volumeSize and opts.dedup_var:
+			print("Dedup needs the hashes before tarring, not splitting into volumes.")
+
+		# The metadata is published to Solr while the files are hashed and
+		# tarred.  It is committed once the archive is complete.
+		catalogFile=None
+		if opts.catalog_var:
+			catalogFile=cfs_catalog.catalogPath(mnt)
+		publisher=publishStart(catalogFile)
+		docPublisher=publisher
+		if resumed:
+			docPublisher=None
+
+		if volumeSize and not opts.dedup_var:
+			# Split the fileList into volumes, each hashed and tarred in
+			# one read on the volume threads.
+			with jobPhase("volArch") as phase:
+				phase["files"],phase["bytes"]=files,size
+				archived=volArch(inventory,archPath,mnt,client,manifest,changed,docPublisher)
+		elif opts.single_pass_var and not opts.dedup_var:
+			# Hash and tar the fileList while reading each file only once.
+			with jobPhase("archObj") as phase:
+				phase["files"],phase["bytes"]=files,size
+				archived=archObj(inventory,archPath,mnt,client,manifest,changed,docPublisher,journal)
+		else:
+			dedupFile,hashes=None,None
+			if opts.dedup_var:
+				dedupFile=os.path.join(mnt,client,archiveDir,dedupIndex)
+			if opts.dedup_var or opts.incremental_var:
+				hashes={}
+			# Pass the inventory of the fileList to the perfMeta function.  A
+			# resumed job keeps the metadata written before the stop.
+			if not journal["meta"]:
+				with jobPhase("perfMeta") as phase:
+					phase["files"],phase["bytes"]=files,size
+					perfMeta(inventory,archPath,mnt,client,manifest,changed,hashes,docPublisher)
+				journalMark(journal,"meta")
+			# Pass the inventory of the fileList to the tarObj function.
+			with jobPhase("tarObj") as phase:
+				phase["files"],phase["bytes"]=files,size
+				archived=tarObj(inventory,archPath,dedupFile,hashes,opts.incremental_var,journal)
+
+		# The manifest is closed before updateIndex() opens it to write
+		if manifest is not None:
+			closeIndex(manifest)
+
+		if resumed:
+			for fileDict in readMeta(metaFile):
+				publishDoc(publisher,fileDict)
+
+		# The time left waiting for Solr once the archive is written
+		with jobPhase("publishEnd"):
+			publishEnd(publisher)
+
+		# The files of an incremental archive are kept, since the next run
+		# is compared against them.  Only the manifest is updated.
+		if archived == True and opts.incremental_var:
+			with jobPhase("updateIndex") as phase:
+				phase["files"]=len(changed)
+				updateIndex(manifestFile,changed)
+			journalMark(journal,"done")
+			print("Changed files archived: "+str(len(changed)))
+		elif archived == True:
+			# The originals are only removed once the journal on disk
+			# shows the archive is complete
+			journalMark(journal,"done")
+			if journalFinished(journal["file"]):
+				removing=tokenizedKept(inventory)
+				with jobPhase("rmFiles") as phase:
+					phase["files"]=len(removing)
+					rmFiles(removing,archPath)
+
+		writeStats(archPath,mnt,client,fileList,files,size)
+		if archived == True:
+			journalEnd(journal)
+	else:
+		print("Permissions error.")
+		sys.exit(6000)
+
+
+
+def jobHeader(fileList,objPath):
+	"""Return the settings of the job, written at the top of its journal"""
+	return({
+		"job":fileStamp,
+		"archive_time":tdyISO,
+		"archive_owner":sudoUser,
+		"targets":fileList,
+		"path":objPath,
+		"single_pass":bool(opts.single_pass_var),
+		"dedup":bool(opts.dedup_var),
+		"incremental":bool(opts.incremental_var),
+		"compress":compressCodec,
+		"volume_size":volumeSize,
+		"digests":hashDigests,
+		"tokenize":opts.tokenize_var,
+		"tokenize_md5":tokenMd5,
+		"tokenize_remove":tokenizeRemove,
+		"delimiter":tokenDelimiter,
+	})
+
+
+
+def journalCreate(journalFile,job,members=None,marks=None):
+	"""Write the journal of a job, with the members and marks kept from an earlier run, and return it"""
+	# The journal is a plain dict: the open file, the members already in
+	# the tar, where the tar and the metadata XML carry on from, and whether
+	# the metadata of a two pass job is complete.
+	members = members or []
+	marks = marks or []
+	journalFh = open(journalFile,"w")
+	journalFh.write("job\t"+json.dumps(job)+"\n")
+	for member in members:
+		journalFh.write(journalLine(member))
+	for mark in marks:
+		journalFh.write(mark+"\n")
+	journalFh.flush()
+	os.fsync(journalFh.fileno())
+	journal = {"file":journalFile,"fh":journalFh,"job":job,"members":members,
+		"names":frozenset(member[6] for member in members),
+		"offset":None,"meta_offset":None,"meta":"meta" in marks}
+	if members:
+		journal["offset"] = int(members[-1][4])
+		if job["single_pass"]:
+			journal["meta_offset"] = int(members[-1][5])
+	return(journal)
+
+
+
+def journalLine(member):
+	"""Format a member of the journal: its offsets, size and hash, where it ends in the tar and XML, and its name"""
+	# Tabs and newlines in the name are escaped, so each member is one line
+	return("member\t"+"\t".join(member[:6])+"\t"+member[6].encode("string_escape")+"\n")
+
+
+
+def journalMember(journal,tarobj,tarinfo,offsets,fileHash="",metaEnd=0):
+	"""Record a member added to the tar in the journal of the job"""
+	if journal is None:
+		return
+	member = (str(offsets[0]),str(offsets[1]),str(tarinfo.size),fileHash,str(tarobj.offset),str(metaEnd),tarinfo.name)
+	journal["fh"].write(journalLine(member))
+	journal["fh"].flush()
+
+
+
+def journalMark(journal,mark):
+	"""Record that a step of the job is complete in its journal"""
+	journal["fh"].write(mark+"\n")
+	journal["fh"].flush()
+	os.fsync(journal["fh"].fileno())
+
+
+
+def journalEnd(journal):
+	"""Close and remove the journal of a finished job"""
+	os.setuid(0)
+	os.setgid(0)
+	journal["fh"].close()
+	os.remove(journalCheck(journal["file"]))
+
+
+
+def journalFinished(journalFile):
+	"""Return True if the journal on disk shows the archive is complete"""
+	# Only the tail is read, the journal holds a line for every member
+	with open(journalFile,"r") as f:
+		f.seek(0,os.SEEK_END)
+		f.seek(max(0,f.tell()-4096))
+		lines = f.read().splitlines()
+	return(bool(lines) and lines[-1] == "done")
+
+
+
+def readJournal(journalFile):
+	"""Return the job, members and marks in a journal"""
+	job,members,marks = None,[],[]
+	with open(journalFile,"r") as f:
+		for line in f:
+			line = line.rstrip("\n")
+			if line.startswith("job\t"):
+				job = json.loads(line[4:],object_hook=journalStrings)
+			elif line.startswith("member\t"):
+				fields = line.split("\t")
+				# A partly written last line is dropped
+				if len(fields) != 8:
+					break
+				members.append(tuple(fields[1:7])+(fields[7].decode("string_escape"),))
+			elif line:
+				marks.append(line)
+	return(job,members,marks)
+
+
+
+def journalStrings(record):
+	"""Encode the strings json.loads() returns as unicode back to the byte strings of the paths"""
+	def encode(value):
+		if isinstance(value,unicode):
+			return(value.encode("utf-8"))
+		if isinstance(value,list):
+			return([encode(item) for item in value])
+		return(value)
+	return(dict((encode(key),encode(value)) for key,value in record.items()))
+
+
+
+def journalEntries(inventory,journal):
+	"""Return the inventory less the members already in the journal of a resumed job"""
+	if journal is None or not journal["names"]:
+		return(inventory)
+	names = journal["names"]
+	return([entry for entry in inventory if entry.path.lstrip("/") not in names])
+
+
+
+def journalCheck(journalFile):
+	"""Return the real path of a journal, exiting unless it is a file owned by root in the archive directory of its client"""
+	# The journal decides what is removed as root, so only a journal this
+	# program wrote is trusted, not one the user put anywhere else.  It is
+	# checked again before it is removed, in case a directory was swapped.
+	realFile = os.path.realpath(journalFile)
+	found = None
+	try:
+		fileData = os.lstat(realFile)
+		if stat.S_ISREG(fileData.st_mode) and fileData.st_uid == os.geteuid():
+			found = findMount(realFile)
+	except OSError:
+		pass
+	if found is None or not realFile.startswith(os.path.join(found[0],found[2],archiveDir)+"/"):
+		print("Not a journal file: "+journalFile)
+		sys.exit(6003)
+	return(realFile)
+
+
+
+def resumeJob(journalFile):
+	"""Resume a stopped archive job from its journal"""
+	global tdy,tdyISO,fileStamp,compressCodec,archiveExt,volumeSize,idDigest,hashDigests
+	global tokenSpecs,tokenMd5,tokenDelimiter,tokenizeRemove
+	journalFile = journalCheck(journalFile)
+	try:
+		job,members,marks = readJournal(journalFile)
+	except (IOError,ValueError):
+		job = None
+	if job is None:
+		print("Not a journal file: "+journalFile)
+		sys.exit(6003)
+	if job["archive_owner"] != sudoUser:
+		print("The job was started by "+str(job["archive_owner"])+", it can only be resumed by them.")
+		sys.exit(6004)
+
+	# Carry on as the job that was stopped, with its time and settings
+	fileStamp = job["job"]
+	try:
+		tdy = datetime.datetime.strptime(fileStamp,"%Y_%m_%d_%H_%M_%S_%f")
+	except (ValueError,TypeError):
+		print("Not a journal file: "+journalFile)
+		sys.exit(6003)
+	tdyISO = job["archive_time"]
+	opts.single_pass_var = job["single_pass"]
+	opts.dedup_var = job["dedup"]
+	opts.incremental_var = job["incremental"]
+	compressCodec = job["compress"]
+	archiveExt = ".tar"+compressExts.get(compressCodec,"")
+	volumeSize = job["volume_size"]
+	hashDigests = job.get("digests",["sha1"])
+	idDigest = hashDigests[0]
+	opts.tokenize_var = job.get("tokenize",[])
+	tokenMd5 = job.get("tokenize_md5",False)
+	tokenizeRemove = job.get("tokenize_remove",False)
+	tokenDelimiter = job.get("delimiter",",")
+	tokenSpecs = tokenizeSpecs(opts.tokenize_var)
+	archPath = os.path.dirname(journalFile)
+
+	# The archive is complete, only the removal of the originals is left.
+	# Only the objects which are members of the archive are removed, so a
+	# file created since the archive was written is left in place.
+	targets = [target for target in job["targets"] if os.path.lexists(target)]
+	if "done" in marks:
+		if targets and not job["incremental"]:
+			names = archivedNames(archPath,job,members)
+			inventory = [entry for entry in takeInventory(targets) if entry.path.lstrip("/") in names]
+			if checkPerm(inventory) != True:
+				print("Permissions error.")
+				sys.exit(6000)
+			rmFiles(tokenizedKept(inventory),archPath)
+		os.setuid(0)
+		os.setgid(0)
+		os.remove(journalCheck(journalFile))
+		print("Job finished: "+fileStamp)
+		return
+
+	if len(targets) != len(job["targets"]):
+		print("Files of the job are missing, it cannot be resumed.")
+		sys.exit(6005)
+
+	# Only a plain tar can be carried on from its last complete member.  A
+	# compressed tar or volumes, and the dedup and incremental jobs, which
+	# need the hashes of every file, are started again.  A two pass job
+	# carries on once its metadata is complete.
+	kept = []
+	resumable = not (compressCodec or volumeSize or job["dedup"] or job["incremental"])
+	if resumable and (job["single_pass"] or "meta" in marks):
+		archFile = os.path.join(archPath,fileStamp+archiveExt)
+		metaFile = os.path.join(archPath,fileStamp+archiveMetaExt)
+		tarSize,metaSize = 0,0
+		if os.path.exists(archFile):
+			tarSize = os.path.getsize(archFile)
+		if os.path.exists(metaFile):
+			metaSize = os.path.getsize(metaFile)
+		for member in members:
+			if int(member[4]) > tarSize or (job["single_pass"] and int(member[5]) > metaSize):
+				break
+			kept.append(member)
+		marks = [mark for mark in marks if mark == "meta"]
+		print("Resuming job "+fileStamp+" after "+str(len(kept))+" members")
+	else:
+		marks = []
+		print("Starting job "+fileStamp+" again")
+
+	journal = journalCreate(journalFile,job,kept,marks)
+	archiveFiles(targets,job["path"],journal)
+
+
+
+def archivedNames(archPath,job,members):
+	"""Return the member names of the finished archive of a job, from its journal, or from the tables of contents of its volumes"""
+	# The members of the volumes are not in the journal, since the volumes
+	# are written on several threads.  The tables of contents of a finished
+	# set are complete.
+	if not job["volume_size"] or job["dedup"]:
+		return(frozenset(member[6] for member in members))
+	names = set()
+	for volFile in archiveVolumes(os.path.join(archPath,job["job"]+archiveExt)):
+		toc = anydbm.open(archiveStem(volFile)+archiveTocExt,"r")
+		try:
+			names.update(toc.keys())
+		finally:
+			toc.close()
+	return(names)
+
+
+
+def inventoryTotals(inventory):
+	"""Return the number of regular files in the inventory, and their total size"""
+	files,size = 0,0
+	for entry in metaFiles(inventory):
+		files += 1
+		size += entry.stat.st_size
+	return(files,size)
+
+
+
+def procIO():
+	"""Return the bytes read and written by the process so far from /proc/self/io, None if unreadable"""
+	# rchar and wchar count every read and write call, including the reads
+	# served from the page cache.  /proc/self/io cannot be read without /proc,
+	# or while the process runs as the sudo user.
+	counters = {}
+	try:
+		with open("/proc/self/io","r") as f:
+			for line in f:
+				name,value = line.split(":",1)
+				counters[name] = int(value)
+	except (IOError,ValueError):
+		return(None)
+	return(counters)
+
+
+
+@contextlib.contextmanager
+def jobPhase(name):
+	"""Time a phase of the job, recording its I/O, memory, NSS and Solr time in jobStats"""
+	# The phase dict is given to the with block, to set the files and bytes
+	# it handles.  The throughput is worked out from those.
+	phase = {"name":name,"files":0,"bytes":0}
+	startIO,startNss,startSolr = procIO(),idStats["seconds"],jobStats["solr_seconds"]
+	startCpu = sum(os.times()[:4])
+	start = time.time()
+	try:
+		yield(phase)
+	finally:
+		seconds = max(time.time()-start,0.000001)
+		endIO = procIO()
+		phase["seconds"] = round(seconds,6)
+		# User and system time of every thread of the process, and of the
+		# child processes it waited for (the csv_hash workers)
+		phase["cpu_seconds"] = round(sum(os.times()[:4])-startCpu,6)
+		phase["bytes_read"],phase["bytes_written"] = None,None
+		if startIO and endIO:
+			phase["bytes_read"] = endIO["rchar"]-startIO["rchar"]
+			phase["bytes_written"] = endIO["wchar"]-startIO["wchar"]
+		phase["files_per_sec"] = round(phase["files"]/seconds,2)
+		phase["mb_per_sec"] = round(phase["bytes"]/seconds/1048576,2)
+		phase["cpu_seconds_per_gb"] = None
+		if phase["bytes"]:
+			phase["cpu_seconds_per_gb"] = round(phase["cpu_seconds"]*1073741824/phase["bytes"],3)
+		phase["peak_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+		phase["nss_seconds"] = round(idStats["seconds"]-startNss,6)
+		# Solr is published to by a background thread, so this is the time
+		# spent in Solr requests while the phase ran
+		phase["solr_seconds"] = round(jobStats["solr_seconds"]-startSolr,6)
+		jobStats["phases"].append(phase)
+
+
+
+def writeStats(archPath,mnt,client,fileList,files,size):
+	"""Write the metrics of the job as JSON, next to the metadata XML"""
+	# rmFiles() leaves the process as the sudo user, the archive files
+	# are written as root
+	os.setuid(0)
+	os.setgid(0)
+	statsFile = os.path.join(archPath,fileStamp+archiveStatsExt)
+	record = {
+		"job":fileStamp,
+		"archive_time":tdyISO,
+		"archive_owner":sudoUser,
+		"mount":mnt,
+		"market":client,
+		"targets":fileList,
+		"files":files,
+		"bytes":size,
+		"seconds":round(sum([phase["seconds"] for phase in jobStats["phases"]]),6),
+		"peak_rss_kb":resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+		"phases":jobStats["phases"],
+		"nss":{"lookups":idStats["lookups"],"hits":idStats["hits"],"seconds":round(idStats["seconds"],6)},
+		"solr":{"requests":jobStats["solr_requests"],"seconds":round(jobStats["solr_seconds"],6)},
+	}
+	with open(statsFile,"w") as f:
+		json.dump(record,f,indent=1,sort_keys=True)
+	print("Job metrics: "+statsFile)
+
+
+
 def main():
 	"""Primary function of the application.  Process control occurs here."""
+	global solrServer,solrPort,tokenSpecs
+	# The stand-in is only started once the options are checked, and the
+	# finally below must not hide the exit code of an earlier error
+	standin=None
 	try:
 
+		if compressCodec == "xz" and lzma is None:
+			print("The xz compression needs the lzma module (backports.lzma on Python 2).")
+			sys.exit(2010)
+
+		for digestName in hashDigests:
+			try:
+				digestNew(digestName)
+			except ValueError:
+				print("Unknown digest: "+digestName+".  The blake2 digests need Python 3.6+ or the pyblake2 module.")
+				sys.exit(2020)
+
+		# The salt files of the --tokenize specs are read as the sudo user
+		tokenSpecs=tokenizeSpecs(opts.tokenize_var)
+
+		# Fill the identity cache with one bulk enumeration, instead of an
+		# NSS lookup for each new uid and gid found.
+		if opts.preload_ids_var:
+			preload_ids()
+
+		# Publish to a local stand-in for Solr, to test or benchmark the
+		# publishing without a real Solr instance.
+		if opts.solr_standin_var:
+			import solr_standin
+			standin=solr_standin.startServer()
+			solrServer,solrPort="127.0.0.1",str(standin.server_address[1])
+
 		# Create an empty list which will be passed to the child functions for iteration. 
 		fileList=[]
 
@@ -614,26 +3351,7 @@ def main():
 					# Filename option is set, append the filename argument to the empty fileList.
 					fileList.append(os.path.realpath(os.path.normpath(os.path.abspath(i))))
 
-				mnt,remainder,client=findMount(os.path.realpath(os.path.normpath(os.path.abspath(opts.filename_var))))
-				archPath=os.path.join(mnt,client,archiveDir,str(tdy.year).zfill(2),str(tdy.month).zfill(2))
-
-				try:
-					os.makedirs(archPath,0700)
-				except OSError:
-					pass
-
-				if checkPerm(fileList) == True:
-					# Set the uid of the program back to root, just in case
-					os.setuid(0)
-					os.setgid(0)
-					# Pass the fileList containing the filename argument to the perfMeta function.
-					perfMeta(fileList,archPath,mnt,client)
-					# Pass the fileList containing the filename argument to the tarObj function.
-					if tarObj(fileList,archPath) == True:
-						rmFiles(fileList,archPath)
-				else:
-					print("Permissions error.")
-					sys.exit(6000)
+				archiveFiles(fileList,opts.filename_var)
 
 			else:
 				print("File does not exist.")
@@ -648,31 +3366,35 @@ def main():
 
 			if fileList:
 
-				mnt,remainder,client=findMount(os.path.realpath(os.path.normpath(os.path.abspath(cwd))))
-				archPath=os.path.join(mnt,client,archiveDir,str(tdy.year).zfill(2),str(tdy.month).zfill(2))
-
-				try:
-					os.makedirs(archPath,0700)
-				except OSError:
-					pass
-
-				if checkPerm(fileList) == True:
-					# Set the uid of the program back to root
-					os.setuid(0)
-					os.setgid(0)
-					# Pass the fileList containing the filename argument to the perfMeta function.
-					perfMeta(fileList,archPath,mnt,client)
-					# Pass the fileList containing the filename argument to the tarObj function.
-					if tarObj(fileList,archPath)== True:
-						rmFiles(fileList,archPath)
-				else:
-					print("Permissions error.")
-					sys.exit(6000)
+				archiveFiles(fileList,cwd)
 
 			else:
 				print("No files in directory.")
 				sys.exit(6002)
 
+		# Carry on with an archive job that was stopped
+		elif opts.resume_var:
+			resumeJob(opts.resume_var)
+
+		# Publish the metadata of an existing XML metadata file, for archives
+		# created while Solr was unavailable.
+		elif opts.publish_meta_var:
+			publishMeta(opts.publish_meta_var)
+
+		# Fill the catalog of a mount from the XML metadata of its archives
+		elif opts.catalog_import_var:
+			catalogImport(opts.catalog_import_var)
+
+		# Read single members of an archive through its table of contents
+		elif opts.toc_list_var:
+			tocList(opts.toc_list_var)
+
+		elif opts.toc_stat_var:
+			tocStat(opts.toc_stat_var,opts.member_var)
+
+		elif opts.toc_extract_var:
+			tocExtract(opts.toc_extract_var,opts.member_var)
+
 		# Check if the cancel option was selected.
 		elif opts.cancel_var:
 			# Since the archive filesystem is on the live filesystem, there is no way to cancel.
@@ -681,10 +3403,14 @@ def main():
 
 		# Check if the unarchive option is set.
 		elif opts.unarch_filename_var:
-			# Currently does not take a list argument for iteration.  Perhaps future version.
-			# fileList.append(opts.unarch_filename_var)
+			# Restore only the members given with -m and in the --member-file,
+			# or the whole archive if there are none.
+			members=list(opts.member_var)
+			if opts.member_file_var:
+				with open(opts.member_file_var,"r") as f:
+					members.extend([line.strip() for line in f if line.strip()])
 			# Pass the argument for the unarchive option directly to the unTarObj function.
-			unTarObj(opts.unarch_filename_var)
+			unTarObj(opts.unarch_filename_var,members)
 
 
 		# Any other options are invalid.
@@ -699,6 +3425,10 @@ def main():
 		#sys.exit(2001)
 		raise
 
+	finally:
+		if standin is not None:
+			print("Solr stand-in: "+str(solr_standin.serverStats(standin)))
+
 
 
 ################################################################################
@@ -0,0 +1,564 @@
+#!/bin/env python
+################################################################################
+# What: cfs_archived.py
+# Why: Run the cfs_archive.py jobs of every user from one long-running service,
+#      queued by priority and limited per mount, so users archiving at the
+#      same time do not saturate a mount.  The cfs_archive wrapper submits the
+#      jobs over a Unix socket.
+################################################################################
+
+################################################################################
+# Import Modules
+################################################################################
+import os
+import sys
+import imp
+import json
+import time
+import errno
+import select
+import signal
+import socket
+import struct
+import datetime
+import traceback
+from optparse import OptionParser
+
+
+
+################################################################################
+# Option Parser
+################################################################################
+# cfs_archive.py parses sys.argv when it is imported, so the options of the
+# daemon are parsed first, and cfs_archive.py is imported once sys.argv has
+# been replaced.
+parser = OptionParser(usage="%prog [options]\n       %prog --submit [--priority N] -- [cfs_archive options]")
+
+# Stop at the first argument that is not an option of the daemon, so the
+# options of the job are passed on to cfs_archive.py as they are
+parser.disable_interspersed_args()
+
+parser.add_option('-S', '--socket',
+	dest='socket_var',
+	default='/var/run/cfs_archived.sock',
+	metavar='SOCKET',
+	help=('Unix socket the jobs are submitted to.  Default is /var/run/cfs_archived.sock.'))
+
+parser.add_option('-j', '--jobs',
+	dest='jobs_var',
+	type='int',
+	default=4,
+	metavar='JOBS',
+	help=('Jobs run at the same time across all mounts.  Default is 4.'))
+
+parser.add_option('-m', '--mount-jobs',
+	dest='mount_jobs_var',
+	type='int',
+	default=2,
+	metavar='JOBS',
+	help=('Jobs run at the same time on each mount.  Default is 2.'))
+
+parser.add_option('-n', '--nice',
+	dest='nice_var',
+	type='int',
+	default=10,
+	metavar='NICE',
+	help=('Niceness the jobs are run with.  Default is 10.'))
+
+parser.add_option('--cache-ttl',
+	dest='cache_ttl_var',
+	type='int',
+	default=600,
+	metavar='SECONDS',
+	help=('Seconds the identity, mount and Solr schema caches are kept before they are refreshed.  Default is 600.'))
+
+parser.add_option('--submit',
+	dest='submit_var',
+	action="store_true",
+	default=False,
+	metavar='SUBMIT',
+	help=('Submit a job with the cfs_archive options after -- to the daemon.'))
+
+parser.add_option('-p', '--priority',
+	dest='priority_var',
+	type='int',
+	default=0,
+	metavar='PRIORITY',
+	help=('Priority of a submitted job.  Higher priorities run first.  Only root can submit above 0.  Default is 0.'))
+
+parser.add_option('--status',
+	dest='status_var',
+	action="store_true",
+	default=False,
+	metavar='STATUS',
+	help=('List the running and queued jobs of the daemon.'))
+
+(opts, arg) = parser.parse_args()
+
+sys.argv=[sys.argv[0]]
+import cfs_archive
+from common_functions import *
+
+
+
+################################################################################
+# Global Variables
+################################################################################
+# Each job is run in a forked child of the daemon, from a fresh copy of
+# cfs_archive.py compiled once when the daemon starts.  The child inherits the
+# caches of common_functions the daemon keeps warm: the identity cache, the
+# mount cache, and the schema of the Solr instance.
+cfsPath=os.path.join(os.path.dirname(os.path.realpath(__file__)),"cfs_archive.py")
+
+# SO_PEERCRED is not defined by the socket module of Python 2
+soPeerCred=getattr(socket,"SO_PEERCRED",17)
+
+# Requests are a line of JSON, the reply is a line of JSON as well
+requestMax=1048576
+
+# The queued jobs are kept as (-priority, job id, job), so sorting them gives
+# the order they are started in.  The running jobs are kept by pid, with the
+# number running on each mount.
+jobQueue=[]
+jobsRunning={}
+mountRunning={}
+jobIds=[0]
+
+# The clients are read without blocking in the select() of serve(), so a slow
+# client does not hold up the other clients or the jobs.  The data read from
+# each connection is kept until its request line is complete, and a client
+# which has not sent it after clientTimeout seconds is dropped.
+clients={}
+clientTimeout=10
+
+
+
+################################################################################
+# Functions
+################################################################################
+def logMsg(msg):
+	"""Print a timestamped line to the log of the daemon"""
+	print(datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")+" "+msg)
+	sys.stdout.flush()
+
+
+
+def refreshCaches():
+	"""Fill the identity cache, empty the mount cache, and fetch the Solr schema again"""
+	clear_ids()
+	preload_ids()
+	clear_mounts()
+	url=cfs_archive.solrUrl()
+	try:
+		cache_solr_schema(url)
+	except Exception as e:
+		# The jobs fetch the schema themselves until Solr is back
+		solrSchemas.pop(url,None)
+		logMsg("Could not fetch the Solr schema from "+url+": "+str(e))
+	return(time.time())
+
+
+
+def peerCreds(conn):
+	"""Return the pid, uid and gid of the process at the other end of a Unix socket"""
+	creds=conn.getsockopt(socket.SOL_SOCKET,soPeerCred,struct.calcsize("3i"))
+	pid,uid,gid=struct.unpack("3i",creds)
+	return(pid,uid,gid)
+
+
+
+def peerGroups(pid,uid,user,gid):
+	"""Return the gids of the groups of the process at the other end of a Unix socket"""
+	# The groups the wrapper passed with -g (id -G) are read from the
+	# kernel instead, since the daemon cannot trust what the client sends.
+	# This holds the LDAP groups NSS does not enumerate.  The process is
+	# waiting for the reply, so its pid has not been reused, which the
+	# uid is checked for as well.
+	groups,uids=None,None
+	try:
+		with open("/proc/%d/status" % pid,"r") as f:
+			for line in f:
+				if line.startswith("Uid:"):
+					uids=[int(x) for x in line.split()[1:]]
+				elif line.startswith("Groups:"):
+					groups=[int(x) for x in line.split()[1:]]
+	except (IOError,ValueError):
+		pass
+	if groups is None or not uids or uids[0] != uid:
+		return(userGroups(user,gid))
+	return(sorted(set([gid]+groups)))
+
+
+
+def userGroups(user,gid):
+	"""Return the gids of the groups of a user, from the identity cache"""
+	# Only used when the groups of the client process cannot be read
+	groups=set([gid])
+	for group in idCache["members"]:
+		if user in idCache["members"][group]:
+			groups.add(group)
+	return(sorted(groups))
+
+
+
+def groupArgs(groups):
+	"""Return the -g option the daemon gives cfs_archive.py, with the groups of the user of a job"""
+	return(["-g",",".join([str(g) for g in groups])])
+
+
+
+def jobGroups(jobArgs,groups):
+	"""Return True if cfs_archive.py would run a job with the groups the daemon gives it"""
+	# The client cannot give its own groups, or leave the -g added after its
+	# options to be read as a positional argument or as the value of its
+	# last option
+	for arg in jobArgs:
+		if arg == "--" or arg.startswith("-g") or arg.startswith("--g"):
+			return(False)
+	try:
+		(jobOpts, jobArg) = cfs_archive.parser.parse_args(list(jobArgs)+groupArgs(groups))
+	except SystemExit:
+		return(False)
+	return(jobOpts.groups_var == groupArgs(groups)[1])
+
+
+
+def jobMount(jobArgs,cwd):
+	"""Return the mount a job works on, from the options it is submitted with"""
+	try:
+		(jobOpts, jobArg) = cfs_archive.parser.parse_args(list(jobArgs))
+	except SystemExit:
+		return(None)
+	target=jobOpts.filename_var or jobOpts.unarch_filename_var or jobOpts.resume_var or jobOpts.toc_extract_var or jobOpts.catalog_import_var or cwd
+	target=os.path.realpath(os.path.join(cwd,target))
+	if "*" in target:
+		target=os.path.dirname(target)
+	found=cfs_archive.findMount(target)
+	if found is None:
+		return("/")
+	return(found[0])
+
+
+
+def readRequest(conn):
+	"""Read the JSON line sent by the other end of a socket"""
+	data=""
+	while not data.endswith("\n") and len(data) < requestMax:
+		chunk=conn.recv(65536)
+		if not chunk:
+			break
+		data+=chunk
+	return(json.loads(data))
+
+
+
+def sendReply(conn,reply):
+	"""Send a JSON reply line to a client"""
+	conn.sendall(json.dumps(reply)+"\n")
+
+
+
+def jobInfo(job):
+	"""Return the fields of a job shown by --status"""
+	return(dict((key,job.get(key)) for key in ("id","user","mount","priority","args","cwd","submitted","started")))
+
+
+
+def submitJob(conn,request):
+	"""Queue the job in a request, as the user at the other end of the socket"""
+	pid,uid,gid=peerCreds(conn)
+	user=uid_to_user(uid)
+	jobArgs=request.get("args")
+	cwd=request.get("cwd")
+	if not user:
+		return({"error":"Unknown user "+str(uid)})
+	if not isinstance(jobArgs,list) or not all(isinstance(x,basestring) for x in jobArgs):
+		return({"error":"No cfs_archive options given"})
+	if not isinstance(cwd,basestring) or not os.path.isabs(cwd) or not os.path.isdir(cwd):
+		return({"error":"Not a directory: "+str(cwd)})
+
+	jobArgs=[x.encode("utf-8") for x in jobArgs]
+	cwd=cwd.encode("utf-8")
+	groups=peerGroups(pid,uid,user,gid)
+	if not jobGroups(jobArgs,groups):
+		return({"error":"The groups of a job are set by the daemon, -g and -- cannot be given"})
+	mount=jobMount(jobArgs,cwd)
+	if mount is None:
+		return({"error":"Invalid cfs_archive options: "+" ".join(jobArgs)})
+
+	# Like nice, only root can raise the priority of a job
+	priority=int(request.get("priority") or 0)
+	if uid != 0:
+		priority=min(priority,0)
+
+	jobIds[0]+=1
+	job={"id":jobIds[0],"user":user,"uid":uid,"gid":gid,"groups":groups,
+		"cwd":cwd,"args":jobArgs,"priority":priority,"mount":mount,
+		"submitted":time.time(),"started":None}
+	jobQueue.append((-priority,job["id"],job))
+	position=sorted(jobQueue).index((-priority,job["id"],job))+1
+	logMsg("Job %d queued for %s on %s (priority %d): %s" % (job["id"],user,mount,priority," ".join(jobArgs)))
+	return({"job":job["id"],"mount":mount,"position":position,"running":len(jobsRunning)})
+
+
+
+def readClient(conn):
+	"""Read what a client sent, and answer it once its request line is complete"""
+	client=clients[conn]
+	try:
+		chunk=conn.recv(65536)
+		client["data"]+=chunk
+		if chunk and not client["data"].endswith("\n") and len(client["data"]) < requestMax:
+			return
+		# The reply is a single line, so it is sent blocking
+		conn.settimeout(clientTimeout)
+		handleClient(conn,client["data"])
+	except socket.error as e:
+		if e.args[0] in (errno.EAGAIN,errno.EINTR):
+			return
+		logMsg("Client error: "+str(e))
+	closeClient(conn)
+
+
+
+def closeClient(conn):
+	"""Close a client connection"""
+	del clients[conn]
+	conn.close()
+
+
+
+def handleClient(conn,data):
+	"""Answer a submission or status request on a client connection"""
+	try:
+		request=json.loads(data)
+	except ValueError:
+		sendReply(conn,{"error":"Invalid request"})
+		return
+	if request.get("status"):
+		sendReply(conn,{"running":[jobInfo(job) for job in jobsRunning.values()],
+			"queued":[jobInfo(item[2]) for item in sorted(jobQueue)]})
+	else:
+		sendReply(conn,submitJob(conn,request))
+
+
+
+def nextJob():
+	"""Take the first queued job whose mount is below its limit off the queue"""
+	for item in sorted(jobQueue):
+		job=item[2]
+		if mountRunning.get(job["mount"],0) < opts.mount_jobs_var:
+			jobQueue.remove(item)
+			return(job)
+	return(None)
+
+
+
+def startJob(job,listener,cfsCode):
+	"""Fork a child to run a job"""
+	pid=os.fork()
+	if pid == 0:
+		listener.close()
+		for conn in clients:
+			conn.close()
+		runJob(job,cfsCode)
+	job["pid"]=pid
+	job["started"]=time.time()
+	jobsRunning[pid]=job
+	mountRunning[job["mount"]]=mountRunning.get(job["mount"],0)+1
+	logMsg("Job %d started as pid %d, waited %.1f seconds" % (job["id"],pid,job["started"]-job["submitted"]))
+
+
+
+def runJob(job,cfsCode):
+	"""Run cfs_archive.py for a job in the forked child, as sudo did for the wrapper"""
+	code=1
+	try:
+		os.setsid()
+		os.nice(opts.nice_var)
+		os.chdir(job["cwd"])
+		os.environ["SUDO_USER"]=job["user"]
+
+		# archive.out is opened as the user, as the redirect of the wrapper
+		# did before cfs_archive.py was run through the daemon
+		os.setgroups(job["groups"])
+		os.setegid(job["gid"])
+		os.seteuid(job["uid"])
+		out=os.open("archive.out",os.O_WRONLY|os.O_APPEND|os.O_CREAT,0644)
+		os.seteuid(0)
+		os.setegid(0)
+		os.setgroups([0])
+
+		devNull=os.open(os.devnull,os.O_RDONLY)
+		os.dup2(devNull,0)
+		os.dup2(out,1)
+		os.dup2(out,2)
+		os.close(devNull)
+		os.close(out)
+
+		# The metrics of the job only count its own NSS lookups
+		idStats.update({"lookups":0,"hits":0,"seconds":0.0})
+
+		sys.argv=[cfsPath]+job["args"]+groupArgs(job["groups"])
+		module=imp.new_module("cfs_archive")
+		module.__file__=cfsPath
+		exec cfsCode in module.__dict__
+		module.main()
+		code=0
+	except SystemExit as e:
+		code=e.code
+		if code is None:
+			code=0
+		elif not isinstance(code,(int,long)):
+			print(code)
+			code=1
+	except:
+		traceback.print_exc()
+	finally:
+		try:
+			sys.stdout.flush()
+			sys.stderr.flush()
+		finally:
+			os._exit(code & 0xff)
+
+
+
+def reapJobs():
+	"""Collect the jobs which have finished"""
+	while jobsRunning:
+		try:
+			pid,status=os.waitpid(-1,os.WNOHANG)
+		except OSError as e:
+			if e.errno == errno.ECHILD:
+				break
+			raise
+		if pid == 0:
+			break
+		job=jobsRunning.pop(pid,None)
+		if job is None:
+			continue
+		mountRunning[job["mount"]]-=1
+		if mountRunning[job["mount"]] == 0:
+			del mountRunning[job["mount"]]
+		code=os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status)
+		logMsg("Job %d finished with exit %d after %.1f seconds" % (job["id"],code,time.time()-job["started"]))
+
+
+
+def stopDaemon(signum,frame):
+	"""Stop accepting jobs on SIGTERM, leaving the running jobs to finish"""
+	raise SystemExit(0)
+
+
+
+def serve():
+	"""Accept jobs on the socket and run them as the limits allow"""
+	if os.geteuid() != 0:
+		print("cfs_archived.py must be run as root.")
+		sys.exit(9100)
+
+	with open(cfsPath,"r") as f:
+		cfsCode=compile(f.read(),cfsPath,"exec")
+
+	try:
+		os.unlink(opts.socket_var)
+	except OSError:
+		pass
+	listener=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	listener.bind(opts.socket_var)
+	# Anyone can submit, the jobs run as the user the socket reports
+	os.chmod(opts.socket_var,0666)
+	listener.listen(64)
+	signal.signal(signal.SIGTERM,stopDaemon)
+
+	refreshed=refreshCaches()
+	logMsg("Listening on "+opts.socket_var)
+	try:
+		while True:
+			reapJobs()
+			if time.time()-refreshed > opts.cache_ttl_var:
+				refreshed=refreshCaches()
+
+			while len(jobsRunning) < opts.jobs_var:
+				job=nextJob()
+				if job is None:
+					break
+				startJob(job,listener,cfsCode)
+
+			# Wake up every second to reap and start jobs
+			try:
+				readable,writable,failed=select.select([listener]+clients.keys(),[],[],1.0)
+			except select.error as e:
+				if e.args[0] == errno.EINTR:
+					continue
+				raise
+			for conn in readable:
+				if conn is listener:
+					conn,address=listener.accept()
+					conn.setblocking(0)
+					clients[conn]={"data":"","opened":time.time()}
+				else:
+					readClient(conn)
+			for conn in clients.keys():
+				if time.time()-clients[conn]["opened"] > clientTimeout:
+					logMsg("Client error: no request after %d seconds" % clientTimeout)
+					closeClient(conn)
+	finally:
+		for conn in clients.keys():
+			closeClient(conn)
+		listener.close()
+		os.unlink(opts.socket_var)
+		for item in sorted(jobQueue):
+			logMsg("Job %d dropped from the queue" % item[2]["id"])
+		logMsg("Stopped with %d jobs running" % len(jobsRunning))
+
+
+
+def request(msg):
+	"""Send a request to the daemon and return its reply"""
+	conn=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+	try:
+		conn.connect(opts.socket_var)
+		sendReply(conn,msg)
+		return(readRequest(conn))
+	except socket.error as e:
+		print("The cfs_archived service is not running on "+opts.socket_var+": "+str(e))
+		sys.exit(9120)
+	finally:
+		conn.close()
+
+
+
+def submit(jobArgs):
+	"""Submit a job to the daemon, and print where it is in the queue"""
+	reply=request({"args":jobArgs,"cwd":os.getcwd(),"priority":opts.priority_var})
+	if "error" in reply:
+		print("Job rejected: "+reply["error"])
+		sys.exit(9110)
+	print("Job %d queued on %s at position %d, %d jobs running.  The output is written to archive.out." % (reply["job"],reply["mount"],reply["position"],reply["running"]))
+
+
+
+def status():
+	"""Print the running and queued jobs of the daemon"""
+	reply=request({"status":True})
+	for state in ("running","queued"):
+		for job in reply[state]:
+			print("%-8s %6d %-12s %4d %-24s %s" % (state,job["id"],job["user"],job["priority"],job["mount"]," ".join(job["args"])))
+
+
+
+################################################################################
+# Program Execution
+################################################################################
+
+if __name__ == "__main__":
+	if opts.submit_var:
+		if not arg:
+			print("No cfs_archive options given.")
+			sys.exit(9110)
+		submit(arg)
+	elif opts.status_var:
+		status()
+	else:
+		serve()
@@ -0,0 +1,381 @@
+#!/bin/env python
+################################################################################
+# What: cfs_benchmark.py
+# Why: Benchmark the phases of cfs_archive.py and csv_hash.py against
+#      reproducible synthetic trees, writing the results to a JSON file so
+#      runs of different versions can be compared
+################################################################################
+
+################################################################################
+# Import Modules
+################################################################################
+import os
+import sys
+import pwd
+import time
+import json
+import shutil
+import hashlib
+import random
+import resource
+import platform
+import datetime
+import tempfile
+from optparse import OptionParser
+
+
+
+################################################################################
+# Option Parser
+################################################################################
+# cfs_archive.py parses sys.argv when it is imported, so the options of the
+# benchmark are parsed first, and the modules are imported once sys.argv has
+# been replaced.
+parser = OptionParser()
+
+parser.add_option('-d', '--dir',
+	dest='dir_var',
+	default='',
+	metavar='DIR',
+	help=('Mount point to build the trees in.  Default is the first of /dev/shm, /run/shm and the temp directory that is a mount point.'))
+
+parser.add_option('-c', '--cases',
+	dest='cases_var',
+	default='tiny,huge,deep,sparse,csv',
+	metavar='CASES',
+	help=('Comma separated trees to benchmark: tiny, huge, deep, sparse and csv.  Default is all of them.'))
+
+parser.add_option('-s', '--scale',
+	dest='scale_var',
+	type='float',
+	default=1.0,
+	metavar='SCALE',
+	help=('Multiply the number and size of the files in every tree.  Default is 1.'))
+
+parser.add_option('--seed',
+	dest='seed_var',
+	type='int',
+	default=1,
+	metavar='SEED',
+	help=('Seed of the tree generator.  The same seed and scale give the same trees.  Default is 1.'))
+
+parser.add_option('-o', '--output',
+	dest='output_var',
+	default='cfs_benchmark.json',
+	metavar='JSONFILE',
+	help=('File the results are written to.  Default is cfs_benchmark.json.'))
+
+parser.add_option('--hash-backend',
+	dest='hash_backend_var',
+	type='choice',
+	choices=['readinto','mmap'],
+	default='readinto',
+	metavar='BACKEND',
+	help=('Hashing backend of cfs_archive.py to benchmark: readinto or mmap.  Default is readinto.'))
+
+parser.add_option('--digests',
+	dest='digests_var',
+	default='sha1',
+	metavar='ALGORITHMS',
+	help=('Comma separated digests computed by the hashing, the first being the id.  Default is sha1.'))
+
+parser.add_option('--csv-workers',
+	dest='csv_workers_var',
+	type='int',
+	default=1,
+	metavar='WORKERS',
+	help=('Number of csv_hash worker processes.  Default is 1, the serial path.'))
+
+parser.add_option('-k', '--keep',
+	dest='keep_var',
+	action="store_true",
+	default=False,
+	metavar='KEEP',
+	help=('Keep the trees and archives once the benchmark is done.'))
+
+(opts, arg) = parser.parse_args()
+
+
+
+################################################################################
+# Global Variables
+################################################################################
+# The shape of each synthetic tree at a scale of 1
+benchTrees={
+	"tiny":{"dirs":50,"files":200,"min_size":0,"max_size":4096},
+	"huge":{"files":4,"min_size":32*1048576,"max_size":64*1048576},
+	"deep":{"depth":64,"files":8,"min_size":512,"max_size":65536},
+	"sparse":{"files":4,"size":64*1048576,"extents":16,"extent_size":65536},
+	"csv":{"files":10,"rows":50000,"columns":8},
+}
+
+# The privileged calls made by cfs_archive.py.  They are replaced by no-ops
+# when the benchmark is not run as root.
+privCalls=["setuid","setgid","setgroups","seteuid","setegid","setresuid","setresgid"]
+
+# Without sudo, the benchmark runs as the user who started it
+if not os.getenv("SUDO_USER"):
+	os.environ["SUDO_USER"]=pwd.getpwuid(os.getuid()).pw_name
+
+sys.argv=[sys.argv[0],"-g",",".join([str(g) for g in os.getgroups()] or [str(os.getgid())])]
+import cfs_archive
+import csv_hash
+
+
+
+################################################################################
+# Functions
+################################################################################
+def stubPrivileges():
+	"""Replace the privileged calls of cfs_archive.py with no-ops, when not running as root"""
+	if os.geteuid() == 0:
+		return(False)
+	for name in privCalls:
+		if hasattr(os,name):
+			setattr(os,name,lambda *args: None)
+	return(True)
+
+
+
+def randomBytes(seed,size):
+	"""Return size reproducible pseudo random bytes for a seed"""
+	# Chained SHA512 blocks are much faster than the random module for data
+	blocks=[]
+	for i in xrange((size+63)//64):
+		blocks.append(hashlib.sha512("%s:%d" % (seed,i)).digest())
+	return("".join(blocks)[:size])
+
+
+
+def writeFile(fileName,size,seed):
+	"""Write a file of size bytes of reproducible data"""
+	# A 1MB block is generated once, and each copy of it is given a
+	# different first line, so no two blocks of the file are the same.
+	block=randomBytes(seed,min(size,1048576))
+	with open(fileName,"wb") as f:
+		written,i=0,0
+		while written < size:
+			data=("%s:%d\n" % (seed,i))+block
+			data=data[:size-written]
+			f.write(data)
+			written+=len(data)
+			i+=1
+
+
+
+def genTiny(treePath,rnd,scale):
+	"""Many tiny files spread over a few directories"""
+	shape=benchTrees["tiny"]
+	for d in xrange(max(1,int(shape["dirs"]*scale))):
+		dirPath=os.path.join(treePath,"dir%04d" % d)
+		os.makedirs(dirPath)
+		for f in xrange(shape["files"]):
+			writeFile(os.path.join(dirPath,"file%05d" % f),rnd.randint(shape["min_size"],shape["max_size"]),rnd.random())
+
+
+
+def genHuge(treePath,rnd,scale):
+	"""A few huge files"""
+	shape=benchTrees["huge"]
+	for f in xrange(max(1,int(shape["files"]*scale))):
+		writeFile(os.path.join(treePath,"huge%02d.bin" % f),rnd.randint(shape["min_size"],shape["max_size"]),rnd.random())
+
+
+
+def genDeep(treePath,rnd,scale):
+	"""A single chain of deeply nested directories, with files at every level"""
+	shape=benchTrees["deep"]
+	dirPath=treePath
+	for d in xrange(max(1,int(shape["depth"]*scale))):
+		dirPath=os.path.join(dirPath,"level%03d" % d)
+		os.makedirs(dirPath)
+		for f in xrange(shape["files"]):
+			writeFile(os.path.join(dirPath,"file%02d" % f),rnd.randint(shape["min_size"],shape["max_size"]),rnd.random())
+
+
+
+def genSparse(treePath,rnd,scale):
+	"""Large files made mostly of holes, with a few extents of data"""
+	shape=benchTrees["sparse"]
+	for f in xrange(max(1,int(shape["files"]*scale))):
+		with open(os.path.join(treePath,"sparse%02d.img" % f),"wb") as fh:
+			for e in xrange(shape["extents"]):
+				fh.seek(rnd.randrange(0,shape["size"]-shape["extent_size"]))
+				fh.write(randomBytes(rnd.random(),shape["extent_size"]))
+			fh.truncate(shape["size"])
+
+
+
+def genCsv(treePath,rnd,scale):
+	"""CSV extracts, with ids and names in the first columns to be hashed"""
+	shape=benchTrees["csv"]
+	for f in xrange(max(1,int(shape["files"]*scale))):
+		with open(os.path.join(treePath,"extract%02d.csv" % f),"w") as fh:
+			fh.write(",".join(["col%d" % c for c in xrange(shape["columns"])])+"\n")
+			for r in xrange(shape["rows"]):
+				fields=[str(rnd.randrange(10**9)),"name%d" % rnd.randrange(10**5)]
+				fields.extend([str(rnd.randrange(10**6)) for c in xrange(shape["columns"]-2)])
+				fh.write(",".join(fields)+"\n")
+
+
+
+def treeStats(inventory):
+	"""Return the number of regular files and their total size in an inventory"""
+	files=[entry for entry in cfs_archive.metaFiles(inventory)]
+	return(len(files),sum([entry.stat.st_size for entry in files]))
+
+
+
+def peakRss():
+	"""Return the peak resident memory of the benchmark so far, in KB"""
+	return(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+
+
+
+def timePhase(phases,name,func,*args):
+	"""Run a phase, recording its time, CPU time and the peak memory"""
+	start,startCpu=time.time(),sum(os.times()[:4])
+	result=func(*args)
+	phases[name]={"seconds":max(time.time()-start,0.000001),"cpu_seconds":round(sum(os.times()[:4])-startCpu,6),"peak_rss_kb":peakRss()}
+	return(result)
+
+
+
+def phaseRates(phases,name,files,size):
+	"""Record the files and bytes handled by a phase, and its throughput"""
+	phase=phases[name]
+	seconds=phase["seconds"]
+	phase.update({
+		"seconds":round(seconds,6),
+		"files":files,
+		"bytes":size,
+		"files_per_sec":round(files/seconds,2),
+		"mb_per_sec":round(size/seconds/1048576,2),
+		"cpu_seconds_per_gb":round(phase["cpu_seconds"]*1073741824/size,3) if size else None,
+	})
+	print("%-10s %10.3fs %10d files %12.2f files/sec %10.2f MB/sec %8.2fs CPU" % (name,seconds,files,files/seconds,size/seconds/1048576,phase["cpu_seconds"]))
+
+
+
+def hashAll(inventory):
+	"""Hash every file of the inventory, without creating any metadata"""
+	for entry,fileHash in cfs_archive.hashFiles(cfs_archive.metaFiles(inventory)):
+		pass
+
+
+
+def csvAll(treePath,outPath):
+	"""Hash the first two columns of every CSV file in a tree with csv_hash"""
+	for fileName in sorted(os.listdir(treePath)):
+		if fileName.endswith(".csv"):
+			csv_hash.csv_file(os.path.join(treePath,fileName),",",[0,1],os.path.join(outPath,fileName),False,"benchmark",opts.csv_workers_var)
+
+
+
+def benchCase(case,benchDir,scale,seed):
+	"""Generate one tree and time every phase against it"""
+	# The phases run in the order of an archive job, then unTarObj restores
+	# the files removed by rmFiles, and csv_hash runs against the restored
+	# CSV files.
+	treePath=os.path.join(benchDir,"proj",case)
+	outPath=os.path.join(benchDir,"csv_out",case)
+	os.makedirs(treePath)
+	os.makedirs(outPath)
+
+	print("Generating tree: "+case)
+	start=time.time()
+	generators={"tiny":genTiny,"huge":genHuge,"deep":genDeep,"sparse":genSparse,"csv":genCsv}
+	generators[case](treePath,random.Random("%s:%d" % (case,seed)),scale)
+	generated=time.time()-start
+
+	# Every case gets an archive of its own
+	cfs_archive.fileStamp="bench_%s_%s" % (case,datetime.datetime.utcnow().strftime("%Y%m%d%H%M%S"))
+	fileList=[treePath]
+	phases={}
+
+	mnt,remainder,client=timePhase(phases,"findMount",cfs_archive.findMount,treePath)
+	phaseRates(phases,"findMount",1,0)
+	archPath=os.path.join(mnt,client,cfs_archive.archiveDir,"bench")
+	if not os.path.isdir(archPath):
+		os.makedirs(archPath,0700)
+
+	inventory=timePhase(phases,"inventory",cfs_archive.takeInventory,fileList)
+	files,size=treeStats(inventory)
+	phaseRates(phases,"inventory",len(inventory),0)
+
+	timePhase(phases,"checkPerm",cfs_archive.checkPerm,inventory)
+	phaseRates(phases,"checkPerm",len(inventory),0)
+	timePhase(phases,"perfHash",hashAll,inventory)
+	phaseRates(phases,"perfHash",files,size)
+	timePhase(phases,"perfMeta",cfs_archive.perfMeta,inventory,archPath,mnt,client)
+	phaseRates(phases,"perfMeta",files,size)
+	timePhase(phases,"tarObj",cfs_archive.tarObj,inventory,archPath)
+	phaseRates(phases,"tarObj",files,size)
+	archFile=os.path.join(archPath,cfs_archive.fileStamp+cfs_archive.archiveExt)
+	phases["tarObj"]["archive_bytes"]=os.path.getsize(archFile)
+	timePhase(phases,"rmFiles",cfs_archive.rmFiles,inventory,archPath)
+	phaseRates(phases,"rmFiles",len(inventory),0)
+	timePhase(phases,"unTarObj",cfs_archive.unTarObj,archFile)
+	phaseRates(phases,"unTarObj",files,size)
+	if case == "csv":
+		timePhase(phases,"csv_hash",csvAll,treePath,outPath)
+		phaseRates(phases,"csv_hash",files,size)
+
+	return({"generate_seconds":round(generated,6),"objects":len(inventory),"files":files,"bytes":size,"phases":phases})
+
+
+
+def benchDirectory():
+	"""Return a new directory for the trees, directly below a mount point findMount() finds"""
+	# findMount() takes the first mount point after root, and the directory
+	# below it as the client, so the mount point must be the first one on
+	# its path (/dev/shm is not when /dev is a mount point too).
+	candidates=[opts.dir_var] if opts.dir_var else ["/dev/shm","/run/shm",tempfile.gettempdir()]
+	for mountPath in candidates:
+		mountPath=os.path.realpath(mountPath)
+		found=cfs_archive.findMount(os.path.join(mountPath,"cfs_bench"))
+		if os.path.isdir(mountPath) and found and found[0] == mountPath:
+			return(tempfile.mkdtemp(prefix="cfs_bench_",dir=mountPath))
+	print("No mount point to build the trees in, use --dir to give one: "+", ".join(candidates))
+	sys.exit(9000)
+
+
+
+################################################################################
+# Program Execution
+################################################################################
+
+if __name__ == "__main__":
+	stubbed=stubPrivileges()
+	cfs_archive.hashBackend=opts.hash_backend_var
+	cfs_archive.hashDigests=[digestName.strip() for digestName in opts.digests_var.lower().split(",") if digestName.strip()]
+	cfs_archive.idDigest=cfs_archive.hashDigests[0]
+	benchDir=benchDirectory()
+
+	results={
+		"version":cfs_archive.parser.version,
+		"python":platform.python_version(),
+		"host":platform.node(),
+		"cpus":cfs_archive.multiprocessing.cpu_count(),
+		"time":datetime.datetime.utcnow().isoformat()+"Z",
+		"seed":opts.seed_var,
+		"scale":opts.scale_var,
+		"hash_backend":opts.hash_backend_var,
+		"digests":opts.digests_var,
+		"csv_workers":opts.csv_workers_var,
+		"privileges_stubbed":stubbed,
+		"cases":{},
+	}
+	try:
+		for case in [c.strip() for c in opts.cases_var.split(",") if c.strip()]:
+			if case not in benchTrees:
+				print("Unknown tree: "+case)
+				sys.exit(9020)
+			results["cases"][case]=benchCase(case,benchDir,opts.scale_var,opts.seed_var)
+	finally:
+		if not opts.keep_var:
+			shutil.rmtree(benchDir,ignore_errors=True)
+
+	with open(opts.output_var,"w") as f:
+		json.dump(results,f,indent=2,sort_keys=True)
+	print("Results: "+opts.output_var)
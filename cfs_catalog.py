@@ -0,0 +1,394 @@
+#!/bin/env python
+################################################################################
+# What: cfs_catalog.py
+# Why: Local SQLite catalog of the metadata of archived files, one per mount,
+#      so archived files can be found without the Solr instance
+################################################################################
+
+################################################################################
+# Import Modules
+################################################################################
+import os
+import sys
+import json
+import time
+import sqlite3
+import calendar
+import datetime
+import threading
+from optparse import OptionParser
+
+
+
+################################################################################
+# Global Variables
+################################################################################
+# The catalog is kept at the top of each mount, next to the client directories,
+# and holds a row for each file of every archive written on the mount.  It is
+# created 0600, so it is searched as root (sudo), like the archive dirs.  Rows are
+# keyed on the archive and the path of the file, so importing the same metadata
+# twice (a resumed job, or a sidecar imported again) replaces the rows.
+catalogFile=".cfs_catalog.db"
+
+# The catalog is written catalogBatch rows per transaction, so the write lock
+# is only held for a moment and the archive jobs running on the same mount take
+# turns.  A job waits up to catalogTimeout seconds for the lock.
+catalogBatch=10000
+catalogTimeout=60
+
+# The columns of the files table, in the order of catalogRow().  The metadata
+# fields without a column (the extra digests and id_digest) are kept as JSON in
+# the extra column.  The sha1 column holds the SHA1 whichever digest the id is.
+# mtime is held as UTC seconds so it can be compared as a range, the other
+# times as the ISO 8601 strings of the metadata.
+catalogColumns=["archive_name","path","name","id","sha1","owner","grp","size",
+	"mode","atime","mtime","ctime","market","mount","archive_time","archive_owner","extra"]
+catalogFields={"owner":"owner","group":"grp","size":"size","mode":"mode","atime":"atime",
+	"ctime":"ctime","market":"market","mount":"mount","archive_time":"archive_time",
+	"archive_owner":"archive_owner"}
+
+catalogSchema=[
+	"""CREATE TABLE IF NOT EXISTS files (
+		archive_name TEXT NOT NULL, path TEXT NOT NULL, name TEXT NOT NULL,
+		id TEXT, sha1 TEXT, owner TEXT, grp TEXT, size INTEGER, mode TEXT,
+		atime TEXT, mtime REAL, ctime TEXT, market TEXT, mount TEXT,
+		archive_time TEXT, archive_owner TEXT, extra TEXT,
+		PRIMARY KEY (archive_name,path,name))""",
+	"CREATE INDEX IF NOT EXISTS files_name ON files (name)",
+	"CREATE INDEX IF NOT EXISTS files_path ON files (path,name)",
+	"CREATE INDEX IF NOT EXISTS files_owner ON files (owner)",
+	"CREATE INDEX IF NOT EXISTS files_mtime ON files (mtime)",
+	"CREATE INDEX IF NOT EXISTS files_size ON files (size)",
+	"CREATE INDEX IF NOT EXISTS files_sha1 ON files (sha1)",
+]
+
+catalogInsert="INSERT OR REPLACE INTO files (%s) VALUES (%s)" % (",".join(catalogColumns),",".join(["?"]*len(catalogColumns)))
+
+# The formats accepted for the times given to a query
+queryTimeFormats=["%Y-%m-%dT%H:%M:%S.%f","%Y-%m-%dT%H:%M:%S","%Y-%m-%d %H:%M:%S","%Y-%m-%d"]
+
+
+
+################################################################################
+# Functions
+################################################################################
+def catalogPath(mnt):
+	"""Return the catalog file of a mount"""
+	return(os.path.join(mnt,catalogFile))
+
+
+
+def findCatalog(path):
+	"""Return the catalog of the mount holding path, looking up from path, or None"""
+	path = os.path.realpath(path)
+	while True:
+		if os.path.exists(os.path.join(path,catalogFile)):
+			return(os.path.join(path,catalogFile))
+		if os.path.ismount(path) or path == os.path.dirname(path):
+			return(None)
+		path = os.path.dirname(path)
+
+
+
+def catalogOpen(fileName,create=False):
+	"""Open a catalog, creating its table and indexes if create is set"""
+	if not create and not os.path.exists(fileName):
+		raise sqlite3.OperationalError("No catalog: "+fileName)
+	# The catalog holds the names, owners and hashes of every client of the
+	# mount, so it is only readable by its owner (root), whatever the umask.
+	# SQLite gives its journal the same mode.
+	if create:
+		try:
+			fd = os.open(fileName,os.O_RDWR|os.O_CREAT,0600)
+			os.fchmod(fd,0600)
+			os.close(fd)
+		except OSError as e:
+			raise sqlite3.OperationalError(str(e))
+	db = sqlite3.connect(fileName,timeout=catalogTimeout,check_same_thread=False)
+	db.text_factory = str
+	if create:
+		for statement in catalogSchema:
+			db.execute(statement)
+		db.commit()
+	return(db)
+
+
+
+def epochTime(isoTime):
+	"""Convert an ISO 8601 time of the metadata, or a date, to UTC seconds"""
+	stamp = isoTime.strip().rstrip("Z")
+	# The times of the metadata are sliced, which is several times faster
+	# than strptime() when importing years of metadata
+	if len(stamp) >= 19 and stamp[10] == "T" and stamp[19:20] in ("","."):
+		seconds = calendar.timegm((int(stamp[0:4]),int(stamp[5:7]),int(stamp[8:10]),int(stamp[11:13]),int(stamp[14:16]),int(stamp[17:19]),0,0,0))
+		return(seconds+float("0"+stamp[19:]))
+	for timeFormat in queryTimeFormats:
+		try:
+			moment = datetime.datetime.strptime(stamp,timeFormat)
+		except ValueError:
+			continue
+		return(calendar.timegm(moment.timetuple())+moment.microsecond/1000000.0)
+	raise ValueError("Not an ISO 8601 time: "+isoTime)
+
+
+
+def isoTime(seconds):
+	"""Convert UTC seconds back to the ISO 8601 time of the metadata"""
+	return(datetime.datetime.utcfromtimestamp(seconds).isoformat()+"Z")
+
+
+
+def catalogRow(fileDict):
+	"""Return the row of the files table for the metadata dict of a file"""
+	row = dict((column,None) for column in catalogColumns)
+	extra = {}
+	for key,value in fileDict.items():
+		if key in catalogFields:
+			row[catalogFields[key]] = value
+		elif key not in ("id","name","path","mtime","archive_name","sha1"):
+			extra[key] = value
+	row["archive_name"] = fileDict.get("archive_name") or ""
+	row["path"] = fileDict.get("path") or ""
+	row["name"] = fileDict.get("name") or ""
+	row["id"] = fileDict.get("id")
+	row["sha1"] = fileDict.get("sha1")
+	if row["sha1"] is None and fileDict.get("id_digest","sha1") == "sha1":
+		row["sha1"] = fileDict.get("id")
+	if row["size"] is not None:
+		row["size"] = int(row["size"])
+	if fileDict.get("mtime"):
+		row["mtime"] = epochTime(fileDict["mtime"])
+	if extra:
+		row["extra"] = json.dumps(extra,sort_keys=True)
+	return(tuple([row[column] for column in catalogColumns]))
+
+
+
+def catalogStart(fileName):
+	"""Open a catalog to add the metadata of an archive job to"""
+	# The catalog is a plain dict like the Solr publisher: the connection, the
+	# rows waiting to be written, and the exception that stopped the writes.
+	# Docs may be added from the volume threads, so the rows are locked.
+	catalog = {"file":fileName,"db":None,"rows":[],"lock":threading.Lock(),"error":None,"docs":0}
+	try:
+		catalog["db"] = catalogOpen(fileName,True)
+	except sqlite3.Error as e:
+		catalog["error"] = e
+	return(catalog)
+
+
+
+def catalogDoc(catalog,fileDict):
+	"""Queue the metadata of a file for the catalog, writing catalogBatch rows at a time"""
+	with catalog["lock"]:
+		if catalog["error"] is not None:
+			return
+		try:
+			catalog["rows"].append(catalogRow(fileDict))
+			if len(catalog["rows"]) >= catalogBatch:
+				catalogFlush(catalog)
+		except (sqlite3.Error,ValueError) as e:
+			catalog["error"] = e
+
+
+
+def catalogFlush(catalog):
+	"""Write the queued rows to the catalog in one transaction"""
+	with catalog["db"]:
+		catalog["db"].executemany(catalogInsert,catalog["rows"])
+	catalog["docs"] += len(catalog["rows"])
+	catalog["rows"] = []
+
+
+
+def catalogEnd(catalog):
+	"""Write the rows left and close the catalog, raising the error that stopped the writes, if any"""
+	with catalog["lock"]:
+		try:
+			if catalog["error"] is None and catalog["rows"]:
+				catalogFlush(catalog)
+		except sqlite3.Error as e:
+			catalog["error"] = e
+		if catalog["db"] is not None:
+			catalog["db"].close()
+			catalog["db"] = None
+	if catalog["error"] is not None:
+		raise catalog["error"]
+	return(catalog["docs"])
+
+
+
+def catalogQuery(db,name=None,path=None,owner=None,sha1=None,mtimeAfter=None,mtimeBefore=None,sizeMin=None,sizeMax=None,limit=100):
+	"""Yield the metadata dict of each file in the catalog matching every filter given, newest archive first"""
+	# name and path are globs.  A glob starting with a literal prefix is
+	# answered from the index, as is an exact name or path.
+	where,args = [],[]
+	for column,value in (("name",name),("path",path)):
+		if value is not None:
+			globWhere(where,args,column,value)
+	for column,value,test in (("owner",owner,"="),("sha1",sha1,"="),("mtime",mtimeAfter,">="),
+			("mtime",mtimeBefore,"<"),("size",sizeMin,">="),("size",sizeMax,"<=")):
+		if value is not None:
+			where.append(column+" "+test+" ?")
+			args.append(value)
+	query = "SELECT "+",".join(catalogColumns)+" FROM files"
+	if where:
+		query += " WHERE "+" AND ".join(where)
+	query += " ORDER BY archive_time DESC,path,name"
+	if limit:
+		query += " LIMIT %d" % limit
+	for row in db.execute(query,args):
+		yield(rowMeta(row))
+
+
+
+def globWhere(where,args,column,pattern):
+	"""Add the conditions matching a column against a glob to a query"""
+	# SQLite only uses an index for a GLOB written into the query, not a bound
+	# one, so the literal prefix of the glob is given as a range as well.
+	prefix = pattern
+	for wildcard in "*?[":
+		prefix = prefix.split(wildcard,1)[0]
+	if prefix == pattern:
+		where.append(column+" = ?")
+		args.append(pattern)
+		return
+	if prefix and ord(prefix[-1]) < 255:
+		where.append(column+" >= ? AND "+column+" < ?")
+		args.extend([prefix,prefix[:-1]+chr(ord(prefix[-1])+1)])
+	where.append(column+" GLOB ?")
+	args.append(pattern)
+
+
+
+def rowMeta(row):
+	"""Turn a row of the files table back into the metadata dict of the file"""
+	fileDict = dict(zip(catalogColumns,row))
+	fileDict["group"] = fileDict.pop("grp")
+	if fileDict["mtime"] is not None:
+		fileDict["mtime"] = isoTime(fileDict["mtime"])
+	fileDict.update(json.loads(fileDict.pop("extra") or "{}"))
+	# The sha1 column repeats the id, unless the id is another digest
+	if fileDict["sha1"] is None or "id_digest" not in fileDict:
+		del fileDict["sha1"]
+	return(fileDict)
+
+
+
+def catalogStats(db):
+	"""Return the number of files and archives in the catalog"""
+	files = db.execute("SELECT COUNT(*) FROM files").fetchone()[0]
+	archives = db.execute("SELECT COUNT(DISTINCT archive_name) FROM files").fetchone()[0]
+	return({"files":files,"archives":archives})
+
+
+
+################################################################################
+# Program Execution
+################################################################################
+
+if __name__ == "__main__":
+	parser = OptionParser(usage="%prog [options] [FILE]",
+		description="Find archived files in the catalog of a mount.  A FILE given is looked up by its full path.")
+	parser.add_option('-c','--catalog',
+		dest='catalog_var',
+		default='',
+		metavar='CATALOG',
+		help=('Catalog file to query.  Default is the catalog of the mount holding the current directory.'))
+	parser.add_option('-n','--name',
+		dest='name_var',
+		default=None,
+		metavar='GLOB',
+		help=('Name of the file, a glob.'))
+	parser.add_option('-p','--path',
+		dest='path_var',
+		default=None,
+		metavar='GLOB',
+		help=('Directory the file was archived from, a glob.'))
+	parser.add_option('-o','--owner',
+		dest='owner_var',
+		default=None,
+		metavar='USER',
+		help=('Owner of the file.'))
+	parser.add_option('--sha1',
+		dest='sha1_var',
+		default=None,
+		metavar='SHA1',
+		help=('SHA1 of the file.'))
+	parser.add_option('--mtime-after',
+		dest='mtime_after_var',
+		default=None,
+		metavar='TIME',
+		help=('Only files modified at or after TIME (UTC, YYYY-MM-DD or ISO 8601).'))
+	parser.add_option('--mtime-before',
+		dest='mtime_before_var',
+		default=None,
+		metavar='TIME',
+		help=('Only files modified before TIME (UTC, YYYY-MM-DD or ISO 8601).'))
+	parser.add_option('--size-min',
+		dest='size_min_var',
+		type='int',
+		default=None,
+		metavar='BYTES',
+		help=('Only files of at least BYTES.'))
+	parser.add_option('--size-max',
+		dest='size_max_var',
+		type='int',
+		default=None,
+		metavar='BYTES',
+		help=('Only files of at most BYTES.'))
+	parser.add_option('-l','--limit',
+		dest='limit_var',
+		type='int',
+		default=100,
+		metavar='ROWS',
+		help=('Most files listed, 0 for all.  Default is 100.'))
+	parser.add_option('--json',
+		dest='json_var',
+		action="store_true",
+		default=False,
+		help=('Print the full metadata of each file as a line of JSON.'))
+	parser.add_option('--stats',
+		dest='stats_var',
+		action="store_true",
+		default=False,
+		help=('Print the number of files and archives in the catalog.'))
+	(opts, arg) = parser.parse_args()
+
+	catalogName = opts.catalog_var or findCatalog(os.getcwd())
+	if not catalogName:
+		print("No catalog found for "+os.getcwd()+", use --catalog to give one.")
+		sys.exit(1)
+
+	path,name = opts.path_var,opts.name_var
+	if arg:
+		path,name = os.path.split(os.path.realpath(arg[0]))
+
+	try:
+		mtimeAfter,mtimeBefore = None,None
+		if opts.mtime_after_var:
+			mtimeAfter = epochTime(opts.mtime_after_var)
+		if opts.mtime_before_var:
+			mtimeBefore = epochTime(opts.mtime_before_var)
+	except ValueError as e:
+		print(str(e))
+		sys.exit(2)
+
+	try:
+		db = catalogOpen(catalogName)
+		if opts.stats_var:
+			print(json.dumps(catalogStats(db),sort_keys=True))
+			sys.exit(0)
+		start = time.time()
+		found = 0
+		for fileDict in catalogQuery(db,name,path,opts.owner_var,opts.sha1_var,mtimeAfter,mtimeBefore,opts.size_min_var,opts.size_max_var,opts.limit_var):
+			found += 1
+			if opts.json_var:
+				print(json.dumps(fileDict,sort_keys=True))
+			else:
+				print("%12d %s %s %s" % (fileDict["size"] or 0,fileDict["mtime"],fileDict["archive_name"],os.path.join(fileDict["path"],fileDict["name"])))
+		sys.stderr.write("%d files (%.3f seconds)\n" % (found,time.time()-start))
+	except sqlite3.Error as e:
+		print("Error reading the catalog: "+str(e))
+		sys.exit(3)
+	sys.exit(0)
@@ -2,87 +2,188 @@ import os
 import sys
 import pwd
 import grp
+import time
+import urllib2
 ################################################################################
 # Common Functions
 ################################################################################
+# IDENTITY CACHE
+# Every user and group lookup is an NSS call, which is a network round trip on
+# LDAP/SSSD backed hosts.  The pwd and grp entries are cached by uid, user
+# name, gid and group name, including lookups which failed (cached as False),
+# along with the member set of each group.  preload_ids() fills the cache in
+# bulk from pwd.getpwall() and grp.getgrall().
+idCache={"pwuid":{},"pwnam":{},"grgid":{},"grnam":{},"members":{}}
+
+# The NSS lookups made, the cache hits, and the seconds spent in NSS, for the
+# metrics of cfs_archive.py
+idStats={"lookups":0,"hits":0,"seconds":0.0}
+
+
+def id_lookup(cacheName,key,lookup):
+	"""Return lookup(key) from the named identity cache, False if not found"""
+	cache=idCache[cacheName]
+	try:
+		entry=cache[key]
+		idStats["hits"]+=1
+		return(entry)
+	except KeyError:
+		pass
+	start=time.time()
+	try:
+		entry=lookup(key)
+	except KeyError:
+		entry=False
+	idStats["lookups"]+=1
+	idStats["seconds"]+=time.time()-start
+	cache[key]=entry
+	return(entry)
+
+
+def cached_pwuid(user):
+	"""Return the pwd entry for a uid, False if not found"""
+	return(id_lookup("pwuid",int(user),pwd.getpwuid))
+
+
+def cached_pwnam(user):
+	"""Return the pwd entry for a username, False if not found"""
+	return(id_lookup("pwnam",user,pwd.getpwnam))
+
+
+def cached_grgid(group):
+	"""Return the grp entry for a gid, False if not found"""
+	return(id_lookup("grgid",int(group),grp.getgrgid))
+
+
+def cached_grnam(group):
+	"""Return the grp entry for a groupname, False if not found"""
+	return(id_lookup("grnam",group,grp.getgrnam))
+
+
+def group_members(group):
+	"""Return the set of usernames listed as members of a gid"""
+	gid=int(group)
+	members=idCache["members"].get(gid)
+	if members is None:
+		entry=cached_grgid(gid)
+		members=frozenset(entry[3]) if entry else frozenset()
+		idCache["members"][gid]=members
+	return(members)
+
+
+def preload_ids():
+	"""Fill the identity cache with every user and group NSS will enumerate"""
+	start=time.time()
+	for entry in pwd.getpwall():
+		idCache["pwuid"].setdefault(entry[2],entry)
+		idCache["pwnam"].setdefault(entry[0],entry)
+	for entry in grp.getgrall():
+		idCache["grgid"].setdefault(entry[2],entry)
+		idCache["grnam"].setdefault(entry[0],entry)
+		idCache["members"].setdefault(entry[2],frozenset(entry[3]))
+	idStats["lookups"]+=2
+	idStats["seconds"]+=time.time()-start
+
+
+def clear_ids():
+	"""Empty the identity cache, so changed users and groups are seen"""
+	for cache in idCache.values():
+		cache.clear()
+
+
+# MOUNT CACHE
+# findMount() tests the components of a path with os.path.ismount(), which
+# stats the path and its parent.  The answers are cached by path, so the jobs
+# run by cfs_archived.py reuse the mount points the daemon has already found.
+mountCache={}
+
+
+def cached_ismount(path):
+	"""Return os.path.ismount(path) from the mount cache"""
+	try:
+		return(mountCache[path])
+	except KeyError:
+		pass
+	mountCache[path]=os.path.ismount(path)
+	return(mountCache[path])
+
+
+def clear_mounts():
+	"""Empty the mount cache, so new and removed mounts are seen"""
+	mountCache.clear()
+
+
+# SOLR SCHEMA CACHE
+# sunburnt fetches the schema of the Solr instance every time it connects.
+# cfs_archived.py fetches it once, and the jobs it runs connect with the copy
+# in solrSchemas instead.
+solrSchemas={}
+
+
+def cache_solr_schema(url):
+	"""Fetch the schema of the Solr instance at url into the schema cache"""
+	solrSchemas[url]=urllib2.urlopen(url+"admin/file/?file=schema.xml",timeout=30).read()
+	return(solrSchemas[url])
+
+
 # VALIDATIONS
 def user_exists(user):
 	"""Verify user is present on system(s)"""
-	try:
-		if pwd.getpwnam(user):
-			return True
-	except KeyError:
-		return(False)
+	return(cached_pwnam(user) is not False)
 
 
 def uid_exists(user):
 	"""Verify UID is present on system(s)"""
-	try:
-		if pwd.getpwuid(int(user)):
-			return True
-	except KeyError:
-		return(False)
+	return(cached_pwuid(user) is not False)
 
 
 def group_exists(group):
 	"""Verify group is present on system(s)"""
-	try:
-		if grp.getgrnam(group):
-			return True
-	except KeyError:
-		return(False)
+	return(cached_grnam(group) is not False)
 
 
 def gid_exists(group):
 	"""Verify GID is present on system(s)"""
-	try:
-		if grp.getgrgid(group):
-			return True
-	except KeyError:
-		return(False)
+	return(cached_grgid(group) is not False)
 
 
 # CONVERSIONS
 def user_to_uid(user):
 	"""Translate a username to a uid."""
-	try:
-		username = pwd.getpwnam(user)[2]
-		return username
-	except KeyError:
-		return(False)
+	entry=cached_pwnam(user)
+	if entry:
+		return(entry[2])
+	return(False)
 
 
 def uid_to_user(user):
 	"""Translate a uid to a username."""
-	try:
-		username = pwd.getpwuid(int(user))[0]
-		return username
-	except KeyError:
-		return(False)
+	entry=cached_pwuid(user)
+	if entry:
+		return(entry[0])
+	return(False)
 
 
 def group_to_gid(group):
 	"""Translate a groupname to a gid."""
-	try:
-		groupname = grp.getgrnam(group)[2]
-		return groupname
-	except KeyError:
-		return(False)
+	entry=cached_grnam(group)
+	if entry:
+		return(entry[2])
+	return(False)
 
 
 def gid_to_group(group):
 	"""Translate a gid to a groupname."""
-	try:
-		groupname = grp.getgrgid(int(group))[0]
-		return groupname
-	except KeyError:
-		return(False)
+	entry=cached_grgid(group)
+	if entry:
+		return(entry[0])
+	return(False)
 
 
 # USER IN GROUP
 def userInGrp(uid,gid):
 	"""Determine if a user is part of a group"""
-	if pwd.getpwuid(uid)[0] in grp.getgrgid(gid)[3]:
+	if uid_to_user(uid) in group_members(gid):
 		return(True)
 	else:
 		return(False)
@@ -24,11 +24,38 @@ import sys
 import string
 import hashlib
 import csv
+import io
+import itertools
+import collections
+import multiprocessing
 from optparse import OptionParser
 
 #################################################################
 # Global Variables
 #################################################################
+# In parallel mode the file is read in chunks of about CHUNKSIZE
+# bytes, each ending on a record boundary.  A chunk which has not
+# found a boundary after CHUNK_LIMIT reads is hashed serially, as
+# is a chunk whose end turns out not to be a boundary, and the rest
+# of the file is split again from the end of its last row.
+CHUNK_LIMIT=8
+
+# The line added after each chunk, which must come out of the
+# csv reader as a row of its own if the chunk ended on a record
+# boundary.  Inside a quoted field it joins the field instead.
+CHUNK_END='csv_hash end of chunk\n'
+
+# The tokens of the values already hashed are kept in TOKEN_CACHE,
+# since the hashed columns repeat the same values many times.  It
+# is two dicts: new tokens go in "recent", and once the recent ones
+# take half of the limit, they become the "old" ones and the older
+# ones are dropped.  A hit in "old" is moved back to "recent", so
+# the values in use stay cached, as with an LRU, for the cost of a
+# dict lookup.  The memory of an entry is estimated as the length
+# of the value and the token, plus CACHE_ENTRY bytes for the string
+# objects and the dict slot.  Each worker process has its own cache.
+CACHE_ENTRY=150
+TOKEN_CACHE={"recent":{},"old":{},"bytes":0,"limit":0,"hits":0,"misses":0}
 
 #################################################################
 # Option Parser
@@ -73,8 +100,27 @@ parser.add_option('-s','--salt',
     metavar='SALT',
     help=('Use a salt value against the data prior to hashing. If the string is an existing filename, it will read the first line of the file and use it as the salt.  Otherwise, the string will be used as the salt.'))
 
-(opts, arg) = parser.parse_args()
- 
+parser.add_option('-c','--cache-size',
+    dest='cache_info',
+    type='int',
+    default=256,
+    metavar='MB',
+    help=('Memory for the cache of the tokens of values already hashed, per worker.  0 disables the cache.  Default is 256.'))
+
+parser.add_option('-w','--workers',
+    dest='workers_info',
+    type='int',
+    default=1,
+    metavar='WORKERS',
+    help=('Number of processes hashing chunks of the file in parallel.  The output is the same as with one.  Default is 1.'))
+
+parser.add_option('--chunk-size',
+    dest='chunk_info',
+    type='int',
+    default=16777216,
+    metavar='BYTES',
+    help=('Size of the chunks of the file handed to the workers.  Default is 16777216.'))
+
 #################################################################
 # Functions
 #################################################################
@@ -100,7 +146,58 @@ def perf_hash (DATA,MD5):
         return(hashlib.sha256(DATA).hexdigest().strip())
 
 
-def csv_file (FILENAME,DELIMITER,FIELDNUM,OUTFILE,MD5FLAG,SALT):
+def cached_hash (DATA,SALTVAR,MD5,CACHE=None):
+    """Return the token of a cell of data from the cache, hashing it with perf_hash() if it is not there"""
+    cache = CACHE
+    if cache is None:
+        cache = TOKEN_CACHE
+    token = cache["recent"].get(DATA)
+    if token is not None:
+        cache["hits"] += 1
+        return(token)
+    # The salt and MD5 flag are the same for the whole file, so the
+    # cell of data alone is the key
+    token = cache["old"].get(DATA)
+    if token is None:
+        cache["misses"] += 1
+        token = perf_hash(SALTVAR+DATA,MD5)
+        if not cache["limit"]:
+            return(token)
+    else:
+        cache["hits"] += 1
+
+    cache["recent"][DATA] = token
+    cache["bytes"] += len(DATA)+len(token)+CACHE_ENTRY
+    if cache["bytes"] >= cache["limit"]/2:
+        cache["old"] = cache["recent"]
+        cache["recent"] = {}
+        cache["bytes"] = 0
+    return(token)
+
+
+def cache_new (CACHEMB):
+    """Return an empty token cache with a memory limit, for callers keeping one per salt"""
+    return({"recent":{},"old":{},"bytes":0,"limit":max(0,CACHEMB)*1048576,"hits":0,"misses":0})
+
+
+def cache_reset (CACHEMB):
+    """Empty the token cache and its counters, and set its memory limit"""
+    TOKEN_CACHE.update(cache_new(CACHEMB))
+
+
+def cache_stats (CACHE=None):
+    """Return the hits, misses and hit rate of the token cache"""
+    cache = CACHE
+    if cache is None:
+        cache = TOKEN_CACHE
+    lookups = cache["hits"]+cache["misses"]
+    rate = 0.0
+    if lookups:
+        rate = 100.0*cache["hits"]/lookups
+    return(cache["hits"],cache["misses"],rate)
+
+
+def csv_file (FILENAME,DELIMITER,FIELDNUM,OUTFILE,MD5FLAG,SALT,WORKERS=1,CHUNKSIZE=16777216,CACHEMB=256):
     """This function performs the csv file handling, and passes the field information to the perf_hash() function"""
     # Create a variable from the SALT metavar.  If the SALT 
     # metavar ends up being a filename, then the SALTVAR is 
@@ -113,7 +210,8 @@ def csv_file (FILENAME,DELIMITER,FIELDNUM,OUTFILE,MD5FLAG,SALT):
     # Try to open the source file for reading.  If any error, 
     # just raise the error without fancy trapping.
     try:
-        r = csv.reader(open(FILENAME, 'r'), dialect='excel', delimiter=DELIMITER)
+        infile = open(FILENAME, 'r')
+        r = csv.reader(infile, dialect='excel', delimiter=DELIMITER)
     except:
         raise
 
@@ -121,7 +219,8 @@ def csv_file (FILENAME,DELIMITER,FIELDNUM,OUTFILE,MD5FLAG,SALT):
     # just raise the error without fancy trapping.  Most common
     # error will be inability to write to directory.
     try:
-        w = csv.writer(open(OUTFILE, 'w'), dialect='excel', delimiter=DELIMITER)
+        outfile = open(OUTFILE, 'w')
+        w = csv.writer(outfile, dialect='excel', delimiter=DELIMITER)
     except:
         raise
 
@@ -154,27 +253,184 @@ def csv_file (FILENAME,DELIMITER,FIELDNUM,OUTFILE,MD5FLAG,SALT):
             except:
                 raise
 
+    # The tokens cached for another file may have another salt
+    cache_reset(CACHEMB)
+
+    # With more than one worker, the chunks of the file are hashed
+    # on a pool of processes
+    if WORKERS > 1:
+        csv_parallel(infile,outfile,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR,WORKERS,CHUNKSIZE)
+        return
+
+    hash_rows(r,w,FIELDNUM,MD5FLAG,SALTVAR)
+
+
+def hash_rows (READER,WRITER,FIELDNUM,MD5FLAG,SALTVAR):
+    """Hash the fields of each row of a csv reader, and write the rows out"""
     # Now to cycle through the rows, checking each field to hash
-    for rows in r:
+    for rows in READER:
         # Cycle through the fields entered for hashing.  Could
         # be multiple fields, thus the for loop.
         for f in FIELDNUM:
             # Set the value of the row/field in question to the
-            # output of the perf_hash() function
-            rows[int(f)] = perf_hash(SALTVAR+rows[int(f)],MD5FLAG)
+            # output of the perf_hash() function, through the cache
+            rows[int(f)] = cached_hash(rows[int(f)],SALTVAR,MD5FLAG)
 
         try:
             # Write out the row, with the hashed field(s)
-            w.writerow(rows)
+            WRITER.writerow(rows)
         except:
             # Something went wrong!
             raise
 
+
+def csv_parallel (INFILE,OUTFILE,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR,WORKERS,CHUNKSIZE):
+    """Hash the chunks of a csv file on a pool of processes, writing them out in order"""
+    # A chunk which cannot be hashed on its own is hashed serially,
+    # and the chunks after it are split again from where its last
+    # row ended, so one bad record does not leave the rest of the
+    # file to the serial path.
+    pool = multiprocessing.Pool(WORKERS)
+    try:
+        start = INFILE.tell()
+        while start is not None:
+            start = csv_pool(pool,INFILE,OUTFILE,start,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR,WORKERS,CHUNKSIZE)
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+def csv_pool (POOL,INFILE,OUTFILE,START,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR,WORKERS,CHUNKSIZE):
+    """Hash the chunks of a csv file from START on the pool.  Returns the offset to split the file again from, after a chunk hashed serially, or None when done"""
+    # Only a few chunks per worker are read ahead, so the memory
+    # used stays bounded for any size of file.
+    INFILE.seek(START)
+    pending = collections.deque()
+    for start,end,chunk in csv_chunks(INFILE,CHUNKSIZE):
+        result = None
+        if chunk is not None:
+            result = POOL.apply_async(hash_chunk,(chunk,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR))
+        pending.append((start,end,result))
+        if chunk is None:
+            break
+        if len(pending) >= WORKERS*2:
+            start,end,result = pending.popleft()
+            if not write_chunk(OUTFILE,result):
+                return(hash_serial(INFILE,OUTFILE,start,end,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR))
+
+    while pending:
+        start,end,result = pending.popleft()
+        if not write_chunk(OUTFILE,result):
+            return(hash_serial(INFILE,OUTFILE,start,end,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR))
+    return(None)
+
+
+def write_chunk (OUTFILE,RESULT):
+    """Write out a hashed chunk, returning False if it could not be hashed"""
+    try:
+        if RESULT is not None:
+            output,hits,misses = RESULT.get()
+            OUTFILE.write(output)
+            TOKEN_CACHE["hits"] += hits
+            TOKEN_CACHE["misses"] += misses
+            return(True)
+    except Exception:
+        # Any error is raised again by the serial path, at the row
+        # which caused it
+        pass
+    return(False)
+
+
+def hash_serial (INFILE,OUTFILE,START,END,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR):
+    """Hash the rows of a csv file from START in this process, up to the first row ending at or after END.  Returns the offset after that row"""
+    # The lines are read with readline(), which does not read ahead,
+    # so the offset of the file is where the last row ended
+    INFILE.seek(START)
+    r = csv.reader(iter(INFILE.readline,''), dialect='excel', delimiter=DELIMITER)
+    w = csv.writer(OUTFILE, dialect='excel', delimiter=DELIMITER)
+    hash_rows(rows_until(r,INFILE,END),w,FIELDNUM,MD5FLAG,SALTVAR)
+    return(INFILE.tell())
+
+
+def rows_until (READER,INFILE,END):
+    """Yield the rows of a csv reader, until a row ends at or after END in the file"""
+    for row in READER:
+        yield(row)
+        if INFILE.tell() >= END:
+            return
+
+
+def csv_chunks (INFILE,CHUNKSIZE):
+    """Yield (offset,end,data) chunks of a csv file, each ending on a record boundary, or (offset,end,None) if no boundary is found"""
+    start = INFILE.tell()
+    data = ''
+    reads = 0
+    while True:
+        block = INFILE.read(CHUNKSIZE)
+        if not block:
+            if data:
+                yield(start,start+len(data),data)
+            return
+        data += block
+        reads += 1
+
+        end = record_end(data)
+        if end == 0:
+            if reads >= CHUNK_LIMIT:
+                yield(start,start+len(data),None)
+                return
+            continue
+        yield(start,start+end,data[:end])
+        start += end
+        data = data[end:]
+        reads = 0
+
+
+def record_end (DATA):
+    """Return the offset after the last newline of DATA which ends a record, or 0 if there is none"""
+    # DATA starts on a record boundary, and a quoted field holds an
+    # even number of quotes, so a newline with an even number of
+    # quotes before it is not inside a quoted field.  The workers
+    # check each chunk ended where its last record did.
+    end = DATA.rfind('\n')
+    quotes = DATA.count('"',0,end)
+    while end >= 0:
+        if quotes % 2 == 0:
+            return(end+1)
+        newline = DATA.rfind('\n',0,end)
+        quotes -= DATA.count('"',newline+1,end)
+        end = newline
+    return(0)
+
+
+def hash_chunk (DATA,DELIMITER,FIELDNUM,MD5FLAG,SALTVAR):
+    """Hash the rows of a chunk of a csv file, run on the worker processes.  Returns the rows and the cache hits and misses"""
+    hits,misses = TOKEN_CACHE["hits"],TOKEN_CACHE["misses"]
+    out = io.BytesIO()
+    r = csv.reader(itertools.chain(io.BytesIO(DATA),[CHUNK_END]), dialect='excel', delimiter=DELIMITER)
+    w = csv.writer(out, dialect='excel', delimiter=DELIMITER)
+    hash_rows(chunk_rows(r,DELIMITER),w,FIELDNUM,MD5FLAG,SALTVAR)
+    return(out.getvalue(),TOKEN_CACHE["hits"]-hits,TOKEN_CACHE["misses"]-misses)
+
+
+def chunk_rows (READER,DELIMITER):
+    """Yield the rows of a chunk, raising an error if the chunk did not end on a record boundary"""
+    row = next(READER)
+    for next_row in READER:
+        yield(row)
+        row = next_row
+    if DELIMITER.join(row)+'\n' != CHUNK_END:
+        raise csv.Error("Chunk does not end on a record boundary")
+
 #################################################################
 # Program Execution
 #################################################################
 
 if __name__ == "__main__":
+    # The options are only parsed when run as a script, so that
+    # cfs_archive.py can import the hashing functions
+    (opts, arg) = parser.parse_args()
+
     try:
         # Validate a filename was passed to hash
         check_options(opts.infilename_info, "infilename_info")
@@ -188,4 +444,7 @@ if __name__ == "__main__":
         raise
 
     # Execute the primary function
-    csv_file(opts.infilename_info, opts.delimiter_info, opts.field_info, opts.outfilename_info, opts.md5_info, opts.salt_info)
\ No newline at end of file
+    csv_file(opts.infilename_info, opts.delimiter_info, opts.field_info, opts.outfilename_info, opts.md5_info, opts.salt_info, opts.workers_info, opts.chunk_info, opts.cache_info)
+
+    # Report how well the repeated values were served from the cache
+    print "Token cache: %d hits, %d misses, %.1f%% hit rate" % cache_stats()
\ No newline at end of file
@@ -0,0 +1,160 @@
+#!/bin/env python
+################################################################################
+# What: solr_standin.py
+# Why: Local stand-in for the Solr update handler, used to test and benchmark
+#      the metadata publishing of cfs_archive.py without a real Solr instance
+################################################################################
+
+################################################################################
+# Import Modules
+################################################################################
+import sys
+import time
+import threading
+import BaseHTTPServer
+import SocketServer
+import xml.etree.ElementTree as ET
+from optparse import OptionParser
+
+
+
+################################################################################
+# Global Variables
+################################################################################
+# The schema served to sunburnt.  Every cfs_archive metadata field is declared
+# as a string, since the stand-in only counts the docs it receives.  That
+# includes the extra digests of the --digests option, and id_digest.
+standinFields=["id","name","path","owner","group","size","mode","atime","mtime",
+	"ctime","market","mount","archive_name","archive_time","archive_owner",
+	"id_digest","md5","sha1","sha224","sha256","sha384","sha512","blake2b","blake2s",
+	"original_id","original_size","tokenized_columns"]
+
+standinSchema="""<?xml version="1.0" encoding="UTF-8"?>
+<schema name="cfs_archive_standin" version="1.5">
+<types><fieldType name="string" class="solr.StrField"/></types>
+<fields>%s<dynamicField name="*" type="string" indexed="true" stored="true"/></fields>
+<uniqueKey>id</uniqueKey>
+</schema>
+"""
+
+standinResponse="""<?xml version="1.0" encoding="UTF-8"?>
+<response><lst name="responseHeader"><int name="status">0</int><int name="QTime">0</int></lst></response>
+"""
+
+
+
+################################################################################
+# Functions
+################################################################################
+class StandinServer(SocketServer.ThreadingMixIn,BaseHTTPServer.HTTPServer):
+	"""Threaded HTTP server holding the counters of the stand-in"""
+	daemon_threads=True
+	allow_reuse_address=True
+
+
+
+class StandinHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+	"""Answer the schema and update requests sunburnt makes"""
+	def do_GET(self):
+		if "schema.xml" in self.path:
+			fields="".join(['<field name="%s" type="string" indexed="true" stored="true"/>' % f for f in standinFields])
+			self.reply(200,standinSchema % fields)
+		else:
+			self.reply(404,"Not found")
+
+	def do_POST(self):
+		body=self.rfile.read(int(self.headers.getheader("content-length") or 0))
+		server=self.server
+
+		if server.delay:
+			time.sleep(server.delay)
+
+		with server.lock:
+			server.requests+=1
+			failed=server.failEvery and server.requests % server.failEvery == 0
+
+		# Fail every failEvery-th request, so the retries of the client can
+		# be tested as well
+		if failed:
+			self.reply(503,"Stand-in failure")
+			return
+
+		docs,commits=0,0
+		if body:
+			update=ET.fromstring(body)
+			docs=len(update.findall("doc"))
+			commits=int(update.tag == "commit")
+		with server.lock:
+			server.docs+=docs
+			server.bytes+=len(body)
+			server.commits+=commits
+		self.reply(200,standinResponse)
+
+	def reply(self,status,content):
+		self.send_response(status)
+		self.send_header("Content-Type","text/xml; charset=utf-8")
+		self.send_header("Content-Length",str(len(content)))
+		self.end_headers()
+		self.wfile.write(content)
+
+	def log_message(self,*args):
+		pass
+
+
+
+def startServer(port=0,failEvery=0,delay=0.0):
+	"""Start a stand-in server on a background thread and return it"""
+	server=StandinServer(("127.0.0.1",port),StandinHandler)
+	server.lock=threading.Lock()
+	server.failEvery=failEvery
+	server.delay=delay
+	server.requests,server.docs,server.bytes,server.commits=0,0,0,0
+
+	thread=threading.Thread(target=server.serve_forever)
+	thread.daemon=True
+	thread.start()
+	return(server)
+
+
+
+def serverStats(server):
+	"""Return the counters of a stand-in server as a dict"""
+	with server.lock:
+		return({"requests":server.requests,"docs":server.docs,"bytes":server.bytes,"commits":server.commits})
+
+
+
+################################################################################
+# Program Execution
+################################################################################
+
+if __name__ == "__main__":
+	parser = OptionParser()
+	parser.add_option('-p','--port',
+		dest='port_var',
+		type='int',
+		default=8080,
+		metavar='PORT',
+		help=('Port to listen on.  Default is 8080.'))
+	parser.add_option('--fail-every',
+		dest='fail_every_var',
+		type='int',
+		default=0,
+		metavar='N',
+		help=('Fail every Nth request with a 503.  Default is 0, never fail.'))
+	parser.add_option('--delay',
+		dest='delay_var',
+		type='float',
+		default=0.0,
+		metavar='SECONDS',
+		help=('Delay every update request.  Default is 0.'))
+	(opts, arg) = parser.parse_args()
+
+	server=startServer(opts.port_var,opts.fail_every_var,opts.delay_var)
+	print("Solr stand-in listening on port "+str(server.server_address[1]))
+	try:
+		while True:
+			time.sleep(1)
+	except KeyboardInterrupt:
+		print(serverStats(server))
+		sys.exit(0)